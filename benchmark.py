@@ -0,0 +1,217 @@
+"""
+Benchmark of meta-training speed on synthetic data, no dataset files are needed.
+
+Every configuration (model, image size, N-way, K-shot, meta batch size) is built and timed in its own
+process, so graph construction, memory and TensorFlow state do not leak between configurations.
+The images are drawn uniformly at random inside the graph, so only the model is measured.
+
+For every configuration the benchmark reports:
+    graph_build_s:      seconds to construct the model (construct_model, including the optimizer)
+    first_step_s:       seconds of the first meta-training step
+    tasks_per_sec:      steady-state meta-training throughput, after the warmup steps
+    peak_rss_mb:        peak resident memory of the process
+
+Usage Instructions:
+    Full sweep, written to benchmark_results.json:
+        python benchmark.py
+
+    A subset, compared against stored results (exits with status 1 on a regression):
+        python benchmark.py --models=r2d2 --datasources=cifarfs --meta_batch_sizes=4 --baseline=benchmark_baseline.json
+
+    Every configuration also with XLA JIT compilation (main.py --xla=True), reporting the speedup:
+        python benchmark.py --xla
+"""
+from __future__ import print_function
+import argparse
+import importlib
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+MODELS = ['r2d2', 'r2d2_paper', 'maml']
+DATASOURCES = ['cifarfs', 'miniimagenet'] # 32x32 and 84x84 images
+IMG_SIZES = {'cifarfs': 32, 'miniimagenet': 84}
+NUM_QUERIES = 15 # query images per class, as in training
+RESULT_PREFIX = 'BENCHMARK_RESULT '
+
+def config_key(config):
+    """ Return the string identifying a configuration, e.g. 'r2d2.cifarfs.5way.1shot.mbs4' """
+    key = '%s.%s.%dway.%dshot.mbs%d' % (config['model'], config['datasource'], config['num_classes'],
+                                         config['update_batch_size'], config['meta_batch_size'])
+    return key + ''.join('.%s_%s' % (flag, value) for flag, value in sorted(config.get('extra_flags', {}).items()))
+
+def config_flags(config):
+    """ Return the command line flags of main.py (or main_paper.py) reproducing a configuration """
+    flags = {'datasource': config['datasource'],
+             'num_classes': config['num_classes'],
+             'update_batch_size': config['update_batch_size'],
+             'meta_batch_size': config['meta_batch_size']}
+    if config['model'] == 'r2d2':
+        flags.update({'num_filters': 32, 'max_pool': True, 'num_updates': 1})
+    elif config['model'] == 'r2d2_paper':
+        flags.update({'model': 'r2d2', 'max_pool': True, 'num_updates': 1})
+    else: # maml
+        flags.update({'num_filters': 32, 'max_pool': True, 'num_updates': 5, 'update_lr': 0.01})
+    flags.update(config.get('extra_flags', {}))
+    return flags
+
+def run_config(config, warmup_steps, steps):
+    """ Build and time one configuration in this process, and print its results as one JSON line """
+    # the flags are defined by the entry point of the model, and parsed from sys.argv on first use
+    sys.argv = sys.argv[:1] + ['--%s=%s' % (flag, value) for flag, value in sorted(config_flags(config).items())]
+    entry = importlib.import_module('main_paper' if config['model'] == 'r2d2_paper' else 'main')
+    FLAGS = entry.FLAGS
+    import tensorflow as tf
+    from utils import session_config
+    if config['model'] == 'r2d2':
+        from r2d2 import R2D2 as Model
+    elif config['model'] == 'r2d2_paper':
+        from r2d2_paper import R2D2_paper as Model
+    else:
+        from maml import MAML as Model
+
+    num_classes, num_shots, batch_size = FLAGS.num_classes, FLAGS.update_batch_size, FLAGS.meta_batch_size
+    dim_input = IMG_SIZES[FLAGS.datasource]**2 * 3
+
+    start_time = time.time()
+    # within a task, support and query images are ordered by class
+    labela = tf.one_hot(tf.tile(tf.range(num_classes), [num_shots]), num_classes)
+    labelb = tf.one_hot(tf.tile(tf.range(num_classes), [NUM_QUERIES]), num_classes)
+    input_tensors = {'inputa': tf.random_uniform([batch_size, num_classes*num_shots, dim_input]),
+                     'inputb': tf.random_uniform([batch_size, num_classes*NUM_QUERIES, dim_input]),
+                     'labela': tf.tile(labela[None], [batch_size, 1, 1]),
+                     'labelb': tf.tile(labelb[None], [batch_size, 1, 1])}
+    model = Model(dim_input, num_classes, test_num_updates=FLAGS.num_updates)
+    model.construct_model(input_tensors=input_tensors, prefix='metatrain_')
+    graph_build_time = time.time() - start_time
+
+    sess = tf.Session(config=session_config())
+    sess.run(tf.global_variables_initializer())
+    start_time = time.time()
+    sess.run(model.metatrain_op)
+    first_step_time = time.time() - start_time
+
+    for _ in range(warmup_steps):
+        sess.run(model.metatrain_op)
+    start_time = time.time()
+    for _ in range(steps):
+        sess.run(model.metatrain_op)
+    tasks_per_sec = steps * batch_size / (time.time() - start_time)
+
+    result = {'key': config_key(config), 'config': config,
+              'graph_build_s': graph_build_time, 'first_step_s': first_step_time, 'tasks_per_sec': tasks_per_sec,
+              'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.} # ru_maxrss is in KB on Linux
+    print(RESULT_PREFIX + json.dumps(result))
+
+def run_config_process(config, args):
+    """ Run one configuration in a separate process, and return its results (with an 'error' entry if it failed) """
+    command = [sys.executable, os.path.abspath(__file__), '--config=' + json.dumps(config),
+               '--warmup_steps=%d' % args.warmup_steps, '--steps=%d' % args.steps]
+    try:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True,
+                                   cwd=os.path.dirname(os.path.abspath(__file__)))
+        stdout, stderr = process.communicate(timeout=args.timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.communicate()
+        return {'key': config_key(config), 'config': config, 'error': 'timeout after %d s' % args.timeout}
+    for line in stdout.splitlines():
+        if line.startswith(RESULT_PREFIX):
+            return json.loads(line[len(RESULT_PREFIX):])
+    # e.g. out of memory, keep the end of the error message
+    return {'key': config_key(config), 'config': config, 'error': (stderr.strip().splitlines() or ['exit status %d' % process.returncode])[-1]}
+
+def compare(results, baseline, tolerance):
+    """ Compare results against baseline results, and return the list of regressions as strings
+
+    A configuration regresses if its throughput dropped, or its graph build time, first step latency or
+    peak memory grew, by more than the tolerance (a fraction), or if it fails while the baseline did not.
+    """
+    baseline = dict((result['key'], result) for result in baseline['results'])
+    regressions = []
+    for result in results:
+        base = baseline.get(result['key'])
+        if base is None or 'error' in base:
+            continue
+        if 'error' in result:
+            regressions.append('%s: failed (%s)' % (result['key'], result['error']))
+            continue
+        if result['tasks_per_sec'] < base['tasks_per_sec'] * (1 - tolerance):
+            regressions.append('%s: tasks_per_sec %.2f < %.2f' % (result['key'], result['tasks_per_sec'], base['tasks_per_sec']))
+        for metric in ['graph_build_s', 'first_step_s', 'peak_rss_mb']:
+            if result[metric] > base[metric] * (1 + tolerance):
+                regressions.append('%s: %s %.2f > %.2f' % (result['key'], metric, result[metric], base[metric]))
+    return regressions
+
+def xla_speedups(results):
+    """ Return (key, speedup) tuples comparing the tasks/sec of every configuration run with and without XLA """
+    results = dict((result['key'], result) for result in results if 'error' not in result)
+    speedups = []
+    for key, result in sorted(results.items()):
+        if result['config'].get('extra_flags', {}).get('xla'):
+            config = dict(result['config'], extra_flags=dict((flag, value) for flag, value in result['config']['extra_flags'].items() if flag != 'xla'))
+            plain = results.get(config_key(config))
+            if plain is not None:
+                speedups.append((key, result['tasks_per_sec'] / plain['tasks_per_sec']))
+    return speedups
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark meta-training speed on synthetic data.')
+    parser.add_argument('--models', default=','.join(MODELS), help='comma separated subset of ' + ', '.join(MODELS))
+    parser.add_argument('--datasources', default=','.join(DATASOURCES), help='comma separated subset of ' + ', '.join(DATASOURCES))
+    parser.add_argument('--ways', default='2,5,20', help='comma separated values of N-way')
+    parser.add_argument('--shots', default='1,5', help='comma separated values of K-shot')
+    parser.add_argument('--meta_batch_sizes', default='1,4,16', help='comma separated meta batch sizes')
+    parser.add_argument('--warmup_steps', type=int, default=3, help='steps after the first one which are not timed')
+    parser.add_argument('--steps', type=int, default=20, help='steps timed for the steady-state throughput')
+    parser.add_argument('--timeout', type=int, default=1800, help='seconds after which a configuration is aborted')
+    parser.add_argument('--output', default='benchmark_results.json', help='file the results are written to')
+    parser.add_argument('--baseline', default=None, help='results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='relative change beyond which a metric counts as a regression')
+    parser.add_argument('--xla', action='store_true', help='also run every configuration with XLA JIT compilation, and report the speedups')
+    parser.add_argument('--config', default=None, help=argparse.SUPPRESS) # one configuration, run in this process
+    args = parser.parse_args()
+
+    if args.config is not None:
+        run_config(json.loads(args.config), args.warmup_steps, args.steps)
+        return
+
+    configs = [{'model': model, 'datasource': datasource, 'num_classes': int(ways), 'update_batch_size': int(shots),
+                'meta_batch_size': int(meta_batch_size)}
+               for model in args.models.split(',') for datasource in args.datasources.split(',')
+               for ways in args.ways.split(',') for shots in args.shots.split(',') for meta_batch_size in args.meta_batch_sizes.split(',')]
+    if args.xla:
+        configs = [dict(config, extra_flags=extra_flags) for config in configs for extra_flags in [{}, {'xla': True}]]
+    results = []
+    for i, config in enumerate(configs):
+        result = run_config_process(config, args)
+        results.append(result)
+        if 'error' in result:
+            print('[%d/%d] %s: failed (%s)' % (i+1, len(configs), result['key'], result['error']))
+        else:
+            print('[%d/%d] %s: build %.1f s, first step %.2f s, %.2f tasks/sec, peak RSS %.0f MB' %
+                  (i+1, len(configs), result['key'], result['graph_build_s'], result['first_step_s'], result['tasks_per_sec'], result['peak_rss_mb']))
+
+    with open(args.output, 'w') as f:
+        json.dump({'results': results, 'python': platform.python_version(), 'host': platform.node(),
+                   'time': time.strftime('%Y-%m-%d %H:%M:%S')}, f, indent=2, sort_keys=True)
+    print('Wrote ' + args.output)
+
+    for key, speedup in xla_speedups(results):
+        print('%s: XLA speedup %.2fx' % (key, speedup))
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('Regression: ' + regression)
+        print('%d regressions against %s' % (len(regressions), args.baseline))
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+"""
+Code for saving checkpoints without blocking training.
+
+AsyncSaver copies the variables into host memory with one session run, and a background thread
+writes the copy to disk with a tf.train.Saver on a separate graph holding variables of the same
+names, so its checkpoints are restored like the ones of tf.train.Saver. Each checkpoint is written
+under a temporary name and renamed once complete, so an interrupted write never leaves a partial
+checkpoint behind; old checkpoints are pruned by the background thread as well.
+
+The state of training which is not held by variables (iteration, episode sampler positions, random
+generators) is saved next to every checkpoint, see save_training_state.
+"""
+from __future__ import print_function
+import glob
+import numpy as np
+import os
+import pickle
+import queue
+import random
+import threading
+import tensorflow as tf
+
+class AsyncSaver(object):
+    """ Drop-in for the save function of tf.train.Saver, writing checkpoints from a background thread """
+    def __init__(self, var_list, max_to_keep=10, checkpoint_dir=None):
+        """
+        Args:
+            var_list:           List of variables to checkpoint
+            max_to_keep:        Integer number of most recent checkpoints to keep
+            checkpoint_dir:     String with the directory the checkpoints are written to, its existing checkpoints
+                                (e.g. of the run being resumed) are kept in the checkpoint state and pruned like new ones
+        """
+        self.var_list = list(var_list)
+        self.max_to_keep = max_to_keep
+        self.checkpoints = []
+        state = tf.train.get_checkpoint_state(checkpoint_dir) if checkpoint_dir else None
+        if state:
+            self.checkpoints = [os.path.normpath(path) for path in state.all_model_checkpoint_paths]
+
+        # variables of the same names and shapes on a separate graph, only used to write the checkpoints
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.writer_vars = [tf.Variable(tf.zeros(var.get_shape(), dtype=var.dtype.base_dtype), name='snapshot_%d' % i)
+                                for i, var in enumerate(self.var_list)]
+            self.saver = tf.train.Saver(dict((var.op.name, writer_var) for var, writer_var in zip(self.var_list, self.writer_vars)),
+                                        max_to_keep=None)
+        self.sess = tf.Session(graph=self.graph)
+
+        # at most one snapshot waits while another is written, so a slow disk cannot exhaust memory
+        self.snapshots = queue.Queue(maxsize=1)
+        self.errors = []
+        self.thread = threading.Thread(target=self._write_snapshots)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def save(self, sess, save_path):
+        """ Snapshot the variables into host memory and queue the snapshot to be written to save_path
+
+        Args:
+            sess:           TensorFlow session object holding the variables
+            save_path:      String with the path prefix of the checkpoint, e.g. logdir + '/model1000'
+
+        returns:
+            string with the path prefix of the checkpoint (written in the background)
+        """
+        if self.errors:
+            raise self.errors[0]
+        self.snapshots.put((sess.run(self.var_list), save_path))
+        return save_path
+
+    def _write_snapshots(self):
+        while True:
+            snapshot = self.snapshots.get()
+            if snapshot is None:
+                return
+            try:
+                self._write(*snapshot)
+            except Exception as e: # reported to the training loop at the next save
+                self.errors.append(e)
+
+    def _write(self, values, save_path):
+        for writer_var, value in zip(self.writer_vars, values):
+            writer_var.load(value, self.sess)
+        checkpoint_dir, name = os.path.split(save_path)
+        tmp_path = os.path.join(checkpoint_dir, '.tmp_' + name)
+        self.saver.save(self.sess, tmp_path, write_meta_graph=False, write_state=False)
+
+        # the data files first, the index last: a checkpoint is only complete once its index exists
+        tmp_files = sorted(glob.glob(tmp_path + '.*'), key=lambda path: path.endswith('.index'))
+        for tmp_file in tmp_files:
+            os.rename(tmp_file, save_path + tmp_file[len(tmp_path):])
+
+        save_path = os.path.normpath(save_path)
+        if save_path in self.checkpoints:
+            self.checkpoints.remove(save_path)
+        self.checkpoints.append(save_path)
+        for old_path in self.checkpoints[:-self.max_to_keep]:
+            # the training states next to the checkpoints are pruned by save_training_state
+            for old_file in glob.glob(old_path + '.index') + glob.glob(old_path + '.data-*'):
+                os.remove(old_file)
+        self.checkpoints = self.checkpoints[-self.max_to_keep:]
+        tf.train.update_checkpoint_state(checkpoint_dir, save_path, all_model_checkpoint_paths=self.checkpoints)
+
+    def close(self):
+        """ Wait until all queued checkpoints are written, and stop the background thread """
+        self.snapshots.put(None)
+        self.thread.join()
+        self.sess.close()
+        if self.errors:
+            raise self.errors[0]
+
+def training_state_path(model_file, rank=0):
+    """ Return the path of the training state saved next to the checkpoint model_file by replica rank """
+    return '%s.state%d.pkl' % (model_file, rank)
+
+def save_training_state(save_path, itr, metatrain_cursor, metaval_cursor, rank=0, max_to_keep=10):
+    """ Save the state of training outside the graph next to the checkpoint save_path
+
+    Together with a checkpoint of all variables (including the optimizer slots), this resumes training
+    on the same tasks: the iteration, the positions of the episode samplers, which determine the tasks
+    with the order and rotations of their classes (see EpisodeSampler), and the state of the python and
+    numpy random generators (e.g. of the sinusoid tasks). The dropout masks of R2D2_paper are drawn in
+    the graph and are not restored. Like the checkpoints, only the states of the max_to_keep most recent
+    iterations are kept.
+
+    Args:
+        save_path:          String with the path prefix of the checkpoint
+        itr:                Integer iteration the checkpoint was saved at
+        metatrain_cursor:   Integer index of the next meta-train episode to be consumed
+        metaval_cursor:     Integer index of the next meta-val episode to be consumed
+        rank:               Integer rank of the replica, each replica samples its own episodes
+        max_to_keep:        Integer number of most recent states to keep, as the max_to_keep of the saver
+    """
+    state = {'itr': itr, 'metatrain_cursor': metatrain_cursor, 'metaval_cursor': metaval_cursor,
+             'python_random': random.getstate(), 'numpy_random': np.random.get_state()}
+    path = training_state_path(save_path, rank)
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump(state, f)
+    os.rename(path + '.tmp', path)
+
+    # the states of the checkpoints pruned by the saver, which are named <checkpoint_dir>/model<itr>
+    checkpoint_dir = os.path.dirname(save_path)
+    state_itrs = sorted(int(os.path.basename(old_path)[len('model'):].split('.')[0])
+                        for old_path in glob.glob(training_state_path(os.path.join(checkpoint_dir, 'model*'), rank)))
+    for old_itr in state_itrs[:-max_to_keep]:
+        os.remove(training_state_path(os.path.join(checkpoint_dir, 'model%d' % old_itr), rank))
+
+def load_training_state(model_file, rank=0):
+    """ Load the training state saved next to the checkpoint model_file, None if there is none (e.g. older checkpoints) """
+    path = training_state_path(model_file, rank)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+def restore_checkpoint(sess, saver, model_file, var_list):
+    """ Restore the variables of var_list from model_file
+
+    Checkpoints which only hold some of the variables (older checkpoints only hold the trainable
+    variables) are restored partially, the other variables (e.g. the optimizer slots) keep their
+    initial values.
+    """
+    saved = set(name for name, _ in tf.train.list_variables(model_file))
+    missing = [var for var in var_list if var.op.name not in saved]
+    if not missing:
+        saver.restore(sess, model_file)
+        return
+    print('Checkpoint holds %d of %d variables, the others (e.g. optimizer slots) start from scratch' %
+          (len(var_list) - len(missing), len(var_list)))
+    tf.train.Saver([var for var in var_list if var.op.name in saved]).restore(sess, model_file)
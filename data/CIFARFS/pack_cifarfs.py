@@ -0,0 +1,77 @@
+"""
+Script for packing CIFAR few shot directly from the CIFAR-100 pickles into memory-mapped arrays, according
+to split specifications in Luca et al. '18.
+
+The images are read straight out of a local cifar-100-python.tar.gz (nothing is downloaded or extracted to
+disk) and written with their original pixels, without the JPEG round-trip of get_cifarfs.py. Every split
+is written as <split>.npy and <split>.index.pkl next to this script, in the format of packed_data.py, with
+the classes sorted by name and the images of a class sorted by their CIFAR-100 filename, as the image
+folders written by get_cifarfs.py are listed.
+
+Run this file as follows:
+    cd data/CIFARFS/
+    python pack_cifarfs.py --tarball=/path/to/cifar-100-python.tar.gz
+
+Then train or test with the '--packed_data=True' flag, no image folders are needed.
+"""
+from __future__ import print_function
+import argparse
+import numpy as np
+import os
+import pickle
+import sys
+import tarfile
+
+# the packing code lives at the root of the repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from packed_data import write_packed_split
+
+IMG_SIZE = (32, 32)
+
+def load_cifar100(tarball):
+    """ Read all 60,000 CIFAR-100 images from the tarball, without extracting it to disk
+
+    returns:
+        tuple (uint8 images [N, 32, 32, 3], fine label names [N], filenames [N])
+    """
+    with tarfile.open(tarball) as tar:
+        def unpickle(name):
+            return pickle.load(tar.extractfile('cifar-100-python/' + name), encoding='bytes')
+        label_names = unpickle('meta')[b'fine_label_names']
+        batches = [unpickle(batch) for batch in ['train', 'test']]
+
+    # rows hold the red, green and blue planes of an image one after the other
+    images = np.concatenate([batch[b'data'] for batch in batches]).reshape(-1, 3, IMG_SIZE[0], IMG_SIZE[1]).transpose(0, 2, 3, 1)
+    labels = np.array([label_names[label].decode() for batch in batches for label in batch[b'fine_labels']])
+    filenames = np.array([filename.decode() for batch in batches for filename in batch[b'filenames']])
+    return np.ascontiguousarray(images), labels, filenames
+
+def main():
+    parser = argparse.ArgumentParser(description='Pack the CIFAR-FS splits from the CIFAR-100 pickles into memory-mapped arrays.')
+    parser.add_argument('--tarball', default='cifar-100-python.tar.gz', help='local copy of cifar-100-python.tar.gz')
+    parser.add_argument('--splits', default='cifar-fs-splits', help='directory with the train.txt, val.txt and test.txt class lists')
+    parser.add_argument('--output', default=os.path.dirname(os.path.abspath(__file__)), help='directory the packed splits are written to')
+    args = parser.parse_args()
+
+    print('Reading ' + args.tarball)
+    images, labels, filenames = load_cifar100(args.tarball)
+
+    for datatype in ['train', 'val', 'test']:
+        with open(os.path.join(args.splits, datatype + '.txt'), 'r') as f:
+            class_names = sorted(line.strip() for line in f if line.strip())
+        class_indices = []
+        for label in class_names:
+            indices = np.flatnonzero(labels == label)
+            if len(indices) == 0:
+                raise ValueError('Class %s of the %s split is not a CIFAR-100 class' % (label, datatype))
+            class_indices.append(indices[np.argsort(filenames[indices])])
+
+        def fill_images(c, out):
+            out[:] = images[class_indices[c]]
+
+        images_path, index_path = write_packed_split(os.path.join(args.output, datatype), class_names,
+                                                     [len(indices) for indices in class_indices], fill_images, IMG_SIZE)
+        print('Wrote %s and %s (%d classes, %d images)' % (images_path, index_path, len(class_names), sum(len(i) for i in class_indices)))
+
+if __name__ == '__main__':
+    main()
@@ -6,41 +6,95 @@ csv files in the miniImagenet directory and put the images in the directory 'min
 Then run this script from the miniImagenet directory:
     cd data/miniImagenet/
     python proc_images.py
+
+Images are resized by a pool of worker processes (one per core by default) straight into their class
+directory. Each image is written under a temporary name and renamed once complete, and its source is
+only removed afterwards, so the script can be interrupted and rerun: images already in place are skipped,
+and the temporary files left by an interrupted run are removed at startup.
+
+To also pack the splits into memory-mapped arrays for training with '--packed_data=True' (see packed_data.py):
+    python proc_images.py --pack
 """
 
 from __future__ import print_function
+import argparse
 import csv
 import glob
+import multiprocessing
 import os
+import sys
 
 from PIL import Image
 
-path_to_images = 'images/'
-
-all_images = glob.glob(path_to_images + '*')
+# the packing code lives at the root of the repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from packed_data import pack_split, packed_paths
 
-# Resize images
-for i, image_file in enumerate(all_images):
-    im = Image.open(image_file)
-    im = im.resize((84, 84), resample=Image.LANCZOS)
-    im.save(image_file)
-    if i % 500 == 0:
-        print(i)
+IMG_SIZE = (84, 84)
 
-# Put in correct directory
-for datatype in ['train', 'val', 'test']:
-    os.system('mkdir ' + datatype)
+def resize_image(paths):
+    """ Resize the image at src to dst, and remove src. Returns True if the image was resized, False if dst already existed """
+    src, dst = paths
+    if not os.path.exists(dst):
+        im = Image.open(src)
+        im = im.resize(IMG_SIZE, resample=Image.LANCZOS)
+        tmp = os.path.join(os.path.dirname(dst), '.tmp_' + os.path.basename(dst))
+        im.save(tmp)
+        os.rename(tmp, dst)
+        resized = True
+    else:
+        resized = False
+    if os.path.exists(src): # left behind if an earlier run stopped between the rename and the removal
+        os.remove(src)
+    return resized
 
+def split_images(datatype, path_to_images):
+    """ Return the (source, destination) paths of the images of a split listed in <datatype>.csv """
+    paths = []
     with open(datatype + '.csv', 'r') as f:
         reader = csv.reader(f, delimiter=',')
-        last_label = ''
         for i, row in enumerate(reader):
             if i == 0:  # skip the headers
                 continue
-            label = row[1]
-            image_name = row[0]
-            if label != last_label:
-                cur_dir = datatype + '/' + label + '/'
-                os.system('mkdir ' + cur_dir)
-                last_label = label
-            os.system('mv images/' + image_name + ' ' + cur_dir)
+            image_name, label = row[0], row[1]
+            paths.append((os.path.join(path_to_images, image_name), os.path.join(datatype, label, image_name)))
+    return paths
+
+def main():
+    parser = argparse.ArgumentParser(description='Resize the miniImagenet images into one directory per split and class.')
+    parser.add_argument('--images', default='images/', help='directory with the original images')
+    parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count(), help='number of worker processes')
+    parser.add_argument('--pack', action='store_true', help='also pack each split into a memory-mapped array, see packed_data.py')
+    args = parser.parse_args()
+
+    # partial images of an interrupted run, their sources are still in place
+    for tmp_file in glob.glob(os.path.join('*', '*', '.tmp_*')):
+        os.remove(tmp_file)
+
+    paths = []
+    for datatype in ['train', 'val', 'test']:
+        paths += split_images(datatype, args.images)
+    for label_dir in sorted(set(os.path.dirname(dst) for _, dst in paths)):
+        if not os.path.isdir(label_dir):
+            os.makedirs(label_dir)
+
+    # Resize images and put them in the correct directory
+    pool = multiprocessing.Pool(args.processes)
+    num_resized = 0
+    for i, resized in enumerate(pool.imap_unordered(resize_image, paths, chunksize=64)):
+        num_resized += resized
+        if i % 5000 == 0:
+            print(i)
+    print('Resized %d images, %d were already in place' % (num_resized, len(paths) - num_resized))
+
+    if args.pack:
+        for datatype in ['train', 'val', 'test']:
+            if num_resized == 0 and all(os.path.exists(path) for path in packed_paths(datatype)):
+                print('Packed ' + datatype + ' is up to date')
+                continue
+            print('Wrote %s and %s' % pack_split(datatype, IMG_SIZE, pool=pool))
+    pool.close()
+    pool.join()
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,6 @@
 """
 Usage instructions:
-    First download the omniglot dataset 
+    First download the omniglot dataset
     and put the contents of both images_background and images_evaluation in data/omniglot/ (without the root folder)
 
     Then, run the following:
@@ -8,22 +8,52 @@ Usage instructions:
     cp -r omniglot/* omniglot_resized/
     cd omniglot_resized/
     python resize_images.py
+
+    The images are resized in place by a pool of worker processes (one per core by default). Each image is
+    written under a temporary name and renamed over the original once complete, so the script can be
+    interrupted and rerun: images which already have the target size are skipped, and the temporary files
+    left by an interrupted run are removed at startup.
 """
+from __future__ import print_function
 from PIL import Image
+import argparse
 import glob
+import multiprocessing
+import os
 
-image_path = '*/*/'
+IMG_SIZE = (28, 28)
 
-all_images = glob.glob(image_path + '*')
+def resize_image(image_file):
+    """ Resize one image in place. Returns True if the image was resized, False if it already had the target size """
+    im = Image.open(image_file) # only reads the header, the size is known before decoding
+    if im.size == IMG_SIZE:
+        return False
+    im = im.resize(IMG_SIZE, resample=Image.LANCZOS)
+    tmp = os.path.join(os.path.dirname(image_file), '.tmp_' + os.path.basename(image_file))
+    im.save(tmp)
+    os.rename(tmp, image_file)
+    return True
 
-i = 0
+def main():
+    parser = argparse.ArgumentParser(description='Resize the omniglot images in place.')
+    parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count(), help='number of worker processes')
+    args = parser.parse_args()
 
-for image_file in all_images:
-    im = Image.open(image_file)
-    im = im.resize((28,28), resample=Image.LANCZOS)
-    im.save(image_file)
-    i += 1
+    image_path = '*/*/'
+    # partial images of an interrupted run, their originals are still in place
+    for tmp_file in glob.glob(image_path + '.tmp_*'):
+        os.remove(tmp_file)
+    all_images = glob.glob(image_path + '*') # skips dot-prefixed names
 
-    if i % 200 == 0:
-        print(i)
+    pool = multiprocessing.Pool(args.processes)
+    num_resized = 0
+    for i, resized in enumerate(pool.imap_unordered(resize_image, all_images, chunksize=64)):
+        num_resized += resized
+        if i % 2000 == 0:
+            print(i)
+    pool.close()
+    pool.join()
+    print('Resized %d images, %d already had size %dx%d' % (num_resized, len(all_images) - num_resized, IMG_SIZE[0], IMG_SIZE[1]))
 
+if __name__ == '__main__':
+    main()
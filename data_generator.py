@@ -1,20 +1,27 @@
 """ Code for loading data. """
 import numpy as np
 import os
+import queue
 import random
 import tensorflow as tf
+import threading
 
 from tensorflow.python.platform import flags
-from utils import get_images
+from utils import get_images, get_manifest
+from packed_data import PackedImageStore, omniglot_splits
+from episode_loader import EpisodeLoader, decode_files
 
 import pickle
 
 FLAGS = flags.FLAGS
 
+# number of meta-batches the tf.data input pipeline keeps ready ahead of training
+PREFETCH_BATCHES = 2
+
 class DataGenerator(object):
     """
-    Data Generator capable of generating batches of miniImageNet or cifar fs data.
-    A "class" is considered a class of miniImagenet or cifar fs images
+    Data Generator capable of generating batches of sinusoid, Omniglot, miniImageNet or cifar fs data.
+    A "class" is considered a character of Omniglot, or a class of miniImagenet or cifar fs images
     """
     def __init__(self, num_samples_per_class, batch_size, config={}):
         """
@@ -26,7 +33,21 @@ class DataGenerator(object):
         self.num_samples_per_class = num_samples_per_class
         self.num_classes = 1  # by default 1 (only relevant for classification problems)
 
-        if FLAGS.datasource == 'miniimagenet':
+        if FLAGS.datasource == 'sinusoid':
+            # tasks are drawn in numpy, main feeds them through placeholders (it checks for a generate attribute)
+            self.generate = self.generate_sinusoid
+            self.amp_range = config.get('amp_range', [0.1, 5.0])
+            self.phase_range = config.get('phase_range', [0, np.pi])
+            self.input_range = config.get('input_range', [-5.0, 5.0])
+            self.dim_input = 1
+            self.dim_output = 1
+            # meta-train batches are drawn ahead by a background thread, optionally into a ring of reused buffers
+            self.prefetch = config.get('prefetch', PREFETCH_BATCHES)
+            self.preallocate = config.get('preallocate', False)
+            self.prefetch_thread = None
+            self.held_buffer = None
+            return # no dataset files
+        elif FLAGS.datasource == 'miniimagenet':
             self.num_classes = config.get('num_classes', FLAGS.num_classes)
             self.img_size = config.get('img_size', (84, 84))
             self.dim_input = np.prod(self.img_size)*3
@@ -37,16 +58,6 @@ class DataGenerator(object):
             else:
                 metaval_folder = config.get('metaval_folder', './data/miniImagenet/val')
 
-            metatrain_folders = [os.path.join(metatrain_folder, label) \
-                for label in os.listdir(metatrain_folder) \
-                if os.path.isdir(os.path.join(metatrain_folder, label)) \
-                ]
-            metaval_folders = [os.path.join(metaval_folder, label) \
-                for label in os.listdir(metaval_folder) \
-                if os.path.isdir(os.path.join(metaval_folder, label)) \
-                ]
-            self.metatrain_character_folders = metatrain_folders
-            self.metaval_character_folders = metaval_folders
             self.rotations = config.get('rotations', [0])
         elif FLAGS.datasource == 'cifarfs':
             self.num_classes = config.get('num_classes', FLAGS.num_classes)
@@ -59,51 +70,357 @@ class DataGenerator(object):
             else:
                 metaval_folder = config.get('metaval_folder', './data/CIFARFS/val')
 
+            self.rotations = config.get('rotations', [0])
+        elif FLAGS.datasource == 'omniglot':
+            self.num_classes = config.get('num_classes', FLAGS.num_classes)
+            self.img_size = config.get('img_size', (28, 28))
+            self.dim_input = np.prod(self.img_size)
+            self.dim_output = self.num_classes
+            # the splits are seeded subsets of the characters, the packed splits are stored next to the characters
+            data_folder = config.get('data_folder', './data/omniglot_resized')
+            metatrain_folder = os.path.join(data_folder, 'train')
+            if FLAGS.test_set:
+                metaval_folder = os.path.join(data_folder, 'test')
+            else:
+                metaval_folder = os.path.join(data_folder, 'val')
+
+            # the packed splits hold every rotation as a class, otherwise classes are rotated in the graph
+            self.rotations = config.get('rotations', [0, 90, 180, 270])
+        else:
+            raise ValueError('Unrecognized data source')
+
+        # whether the class listings may be cached on disk, see utils.get_manifest
+        self.persist_manifest = config.get('persist_manifest', True)
+        if FLAGS.packed_data:
+            # one contiguous uint8 array per split, written once by packed_data.py
+            self.metatrain_store = PackedImageStore(metatrain_folder)
+            self.metaval_store = PackedImageStore(metaval_folder)
+            metatrain_folders = [os.path.join(metatrain_folder, label) for label in self.metatrain_store.class_names]
+            metaval_folders = [os.path.join(metaval_folder, label) for label in self.metaval_store.class_names]
+        elif FLAGS.datasource == 'omniglot':
+            splits = omniglot_splits(data_folder)
+            metatrain_folders = splits['train']
+            metaval_folders = splits[os.path.basename(metaval_folder)]
+        else:
+            # class listings come from the (cached) manifest of each split, see utils.get_manifest
             metatrain_folders = [os.path.join(metatrain_folder, label) \
-                for label in os.listdir(metatrain_folder) \
-                if os.path.isdir(os.path.join(metatrain_folder, label)) \
+                for label in sorted(get_manifest(metatrain_folder, self.persist_manifest)) \
                 ]
             metaval_folders = [os.path.join(metaval_folder, label) \
-                for label in os.listdir(metaval_folder) \
-                if os.path.isdir(os.path.join(metaval_folder, label)) \
+                for label in sorted(get_manifest(metaval_folder, self.persist_manifest)) \
                 ]
-            self.metatrain_character_folders = metatrain_folders
-            self.metaval_character_folders = metaval_folders
-            self.rotations = config.get('rotations', [0])
-        else:
-            raise ValueError('Unrecognized data source')
+        self.metatrain_character_folders = metatrain_folders
+        self.metaval_character_folders = metaval_folders
 
 
-    def make_data_tensor(self, train=True):
+    def make_data_tensor(self, train=True, seed=None, cursor=0, num_episodes=600):
+        """ Build the tensors holding one meta-batch of tasks
+
+        Tasks are sampled lazily by an EpisodeSampler, so graph construction does not depend
+        on the number of tasks that will be drawn during training.
+
+        Args:
+            train:          A boolean, sample from the meta-train split if True, from the meta-val split otherwise
+            seed:           Integer seed of the episode sampler, drawn from the random module if None
+            cursor:         Integer index of the first episode to sample, to resume training where it stopped
+            num_episodes:   Integer number of distinct meta-val tasks which are cycled through (meta-train tasks are unbounded)
+
+        returns:
+            tuple (images of shape [batch_size, num_classes*num_samples_per_class, dim_input], one hot labels)
+        """
+        next_episodes = self.make_input_pipeline(train, seed, cursor, num_episodes)
+        return self.make_episodes(*next_episodes())
+
+    def make_switched_data_tensor(self, use_metaval, metatrain_seed=None, metatrain_cursor=0, metaval_seed=None, metaval_cursor=0, num_episodes=600):
+        """ Build the tensors holding one meta-batch of tasks, from the meta-train or the meta-val split
+
+        A single model graph is built on these tensors for meta-training and meta-validation. Both input
+        pipelines are built, but only the one selected by use_metaval is consumed by a run.
+
+        Args:
+            use_metaval:        Boolean scalar tensor, sample from the meta-val split if True, from the meta-train split otherwise
+            metatrain_seed:     Integer seed of the meta-train episode sampler, drawn from the random module if None
+            metatrain_cursor:   Integer index of the first meta-train episode to sample
+            metaval_seed:       Integer seed of the meta-val episode sampler, drawn from the random module if None
+            metaval_cursor:     Integer index of the first meta-val episode to sample
+            num_episodes:       Integer number of distinct meta-val tasks which are cycled through
+
+        returns:
+            tuple (images of shape [batch_size, num_classes*num_samples_per_class, dim_input], one hot labels)
+        """
+        next_metatrain_episodes = self.make_input_pipeline(True, metatrain_seed, metatrain_cursor)
+        next_metaval_episodes = self.make_input_pipeline(False, metaval_seed, metaval_cursor, num_episodes)
+        # the meta-batch is taken from the input pipelines inside the branches, so the other pipeline is left untouched
+        episodes = tf.cond(use_metaval, next_metaval_episodes, next_metatrain_episodes)
+        return self.make_episodes(*episodes)
+
+    def make_input_pipeline(self, train=True, seed=None, cursor=0, num_episodes=600):
+        """ Build the input pipeline of a split, which produces the images of one meta-batch at a time
+
+        Args: see make_data_tensor
+
+        returns:
+            function building the ops which take the next meta-batch out of the pipeline: a tuple of its images, of shape
+            [batch_size*num_classes*num_samples_per_class, dim_input], and its presentation orders and rotations (see
+            EpisodeSampler.presentation). The ops only consume a meta-batch when they run, so they can be built inside a tf.cond branch
+        """
         if train:
             folders = self.metatrain_character_folders
-            # number of tasks, not number of meta-iterations. (divide by metabatch size to measure)
-            num_total_batches = 200000
+            # tasks are sampled on the fly, without a bound on their number
+            num_episodes = cycle_length = None
         else:
             folders = self.metaval_character_folders
-            num_total_batches = 600
-
-        # make list of files
-        print('Generating filenames')
-        all_filenames = []
-        
-        
-        # Generate filenames list and save to file
-        for _ in range(num_total_batches):
-            sampled_character_folders = random.sample(folders, self.num_classes)
-            random.shuffle(sampled_character_folders)
-            labels_and_images = get_images(sampled_character_folders, range(self.num_classes), nb_samples=self.num_samples_per_class, shuffle=False)
-            # make sure the above isn't randomized order
-            labels = [li[0] for li in labels_and_images]
-            filenames = [li[1] for li in labels_and_images]
-            all_filenames.extend(filenames)
-
-        # make queue for tensorflow to read from
-        filename_queue = tf.train.string_input_producer(tf.convert_to_tensor(all_filenames), shuffle=False)
-        print('Generating image processing ops')
-        image_reader = tf.WholeFileReader()
-        _, image_file = image_reader.read(filename_queue)
-        
+            # a fixed set of tasks, which is cycled through in whole meta-batches: every cycle starts a meta-batch,
+            # and the surplus tasks of its last meta-batch (repeating the first ones) are dropped by the evaluation
+            cycle_length = -(-num_episodes // self.batch_size) * self.batch_size
+        if seed is None:
+            seed = random.randint(0, 2**31 - 1)
+
+        examples_per_batch = self.num_classes * self.num_samples_per_class # amount of examples in task
+        batch_image_size = self.batch_size  * examples_per_batch # amount of examples in batch of tasks
+        # images within a task are ordered by class, see EpisodeSampler.episode
+        orders_shape = (self.batch_size, self.num_samples_per_class, self.num_classes)
+        rotations_shape = (self.batch_size, self.num_classes)
+
+        loader = None
+        if FLAGS.input_pipeline == 'workers':
+            # worker processes assemble whole meta-batches into a shared-memory ring buffer
+            if FLAGS.packed_data:
+                store = self.metatrain_store if train else self.metaval_store
+                class_sizes, load_images, image_shape = store.class_sizes, store.gather, store.image_shape
+            else:
+                labels_and_images = get_images(folders, range(len(folders)), shuffle=False, persist_manifest=self.persist_manifest)
+                class_sizes = np.bincount([li[0] for li in labels_and_images], minlength=len(folders))
+                filenames = np.array([li[1] for li in labels_and_images])
+                image_shape = tuple(self.img_size) + (self.dim_input // np.prod(self.img_size),)
+                load_images = lambda indices: decode_files(filenames[indices], self.img_size, image_shape[2])
+                if FLAGS.datasource == 'omniglot':
+                    decode_images = load_images
+                    load_images = lambda indices: 255 - decode_images(indices) # invert, strokes become 1 as in decode_image
+            sampler = EpisodeSampler(class_sizes, self.num_classes, self.num_samples_per_class, seed=seed, num_episodes=num_episodes, cursor=cursor, cycle_length=cycle_length)
+            print('Starting %d episode loader workers' % FLAGS.num_loader_workers)
+            loader = EpisodeLoader(load_images, sampler, self.batch_size, image_shape, num_workers=FLAGS.num_loader_workers)
+            def next_batch():
+                start = sampler.cursor # advanced by the loader
+                return (loader.next_batch(),) + sampler.presentations(start, self.batch_size)
+            def next_episodes():
+                images, orders, rotations = tf.py_func(next_batch, [], [tf.uint8, tf.int32, tf.int32])
+                images.set_shape((batch_image_size,) + tuple(image_shape))
+                orders.set_shape(orders_shape)
+                rotations.set_shape(rotations_shape)
+                images = tf.reshape(images, [batch_image_size, self.dim_input])
+                return tf.cast(images, tf.float32) / 255.0, orders, rotations
+        elif FLAGS.packed_data:
+            # assemble tasks by indexing into the memory-mapped split, no file reads or decoding
+            store = self.metatrain_store if train else self.metaval_store
+            sampler = EpisodeSampler(store.class_sizes, self.num_classes, self.num_samples_per_class, seed=seed, num_episodes=num_episodes, cursor=cursor, cycle_length=cycle_length)
+            def sample_images():
+                indices, orders, rotations = sampler.next_batch(self.batch_size, presentation=True)
+                return store.gather(indices.reshape(-1)), orders, rotations
+            if FLAGS.input_pipeline == 'tf.data':
+                print('Generating packed image dataset')
+                def generate_images():
+                    while True:
+                        yield sample_images()
+                dataset = tf.data.Dataset.from_generator(generate_images, (tf.uint8, tf.int32, tf.int32),
+                                                         ((batch_image_size,) + store.image_shape, orders_shape, rotations_shape))
+                iterator = dataset.prefetch(PREFETCH_BATCHES).make_one_shot_iterator()
+                take_images = iterator.get_next
+            else:
+                print('Generating packed image sampling ops')
+                def take_images():
+                    images, orders, rotations = tf.py_func(sample_images, [], [tf.uint8, tf.int32, tf.int32])
+                    images.set_shape((batch_image_size,) + store.image_shape)
+                    orders.set_shape(orders_shape)
+                    rotations.set_shape(rotations_shape)
+                    return images, orders, rotations
+            def next_episodes():
+                images, orders, rotations = take_images()
+                images = tf.reshape(images, [batch_image_size, self.dim_input])
+                return tf.cast(images, tf.float32) / 255.0, orders, rotations
+        else:
+            # class -> image index table: all images of the split, ordered by class
+            print('Generating filename table')
+            labels_and_images = get_images(folders, range(len(folders)), shuffle=False, persist_manifest=self.persist_manifest)
+            class_sizes = np.bincount([li[0] for li in labels_and_images], minlength=len(folders))
+            filenames = np.array([li[1].encode() for li in labels_and_images])
+            sampler = EpisodeSampler(class_sizes, self.num_classes, self.num_samples_per_class, seed=seed, num_episodes=num_episodes, cursor=cursor, cycle_length=cycle_length)
+
+            def sample_filenames():
+                indices, orders, rotations = sampler.next_batch(1, presentation=True)
+                return filenames[indices.reshape(-1)], orders[0], rotations[0]
+            if FLAGS.input_pipeline == 'tf.data':
+                # one element per file: read and decode files in parallel, then group them into tasks and meta-batches.
+                # The presentation of a task is carried along with each of its files, and taken once per task
+                print('Generating image dataset')
+                def generate_filenames():
+                    while True:
+                        yield sample_filenames()
+                dataset = tf.data.Dataset.from_generator(generate_filenames, (tf.string, tf.int32, tf.int32),
+                                                         ((examples_per_batch,), orders_shape[1:], rotations_shape[1:]))
+                dataset = dataset.flat_map(lambda task_filenames, orders, rotations: tf.data.Dataset.zip((
+                    tf.data.Dataset.from_tensor_slices(task_filenames), tf.data.Dataset.from_tensors((orders, rotations)).repeat())))
+                dataset = dataset.map(lambda filename, presentation: (self.decode_image(tf.read_file(filename)), presentation),
+                                      num_parallel_calls=FLAGS.num_parallel_calls)
+                dataset = dataset.batch(examples_per_batch)
+                dataset = dataset.map(lambda task_images, presentation: (task_images, presentation[0][0], presentation[1][0]))
+                dataset = dataset.batch(self.batch_size)
+                iterator = dataset.prefetch(PREFETCH_BATCHES).make_one_shot_iterator()
+                take_images = iterator.get_next
+            elif FLAGS.input_pipeline == 'queue':
+                # every run of the enqueue op samples the filenames of one task and decodes its images
+                print('Generating image processing ops')
+                task_filenames, task_orders, task_rotations = tf.py_func(sample_filenames, [], [tf.string, tf.int32, tf.int32])
+                task_filenames.set_shape((examples_per_batch,))
+                task_orders.set_shape(orders_shape[1:])
+                task_rotations.set_shape(rotations_shape[1:])
+                task_images = tf.map_fn(lambda filename: self.decode_image(tf.read_file(filename)), task_filenames, dtype=tf.float32, back_prop=False)
+
+                # a single thread keeps the order of the tasks equal to the order of the sampler
+                num_preprocess_threads = 1
+                print('Batching images')
+                # the queue of tf.train.batch, with the dequeue built apart from it
+                queue = tf.FIFOQueue(capacity=3 * self.batch_size, dtypes=[tf.float32, tf.int32, tf.int32],
+                                     shapes=[task_images.get_shape(), orders_shape[1:], rotations_shape[1:]])
+                tf.train.add_queue_runner(tf.train.QueueRunner(queue, [queue.enqueue([task_images, task_orders, task_rotations])] * num_preprocess_threads))
+                take_images = lambda: queue.dequeue_many(self.batch_size)
+            else:
+                raise ValueError('Unrecognized input pipeline: ' + FLAGS.input_pipeline)
+            def next_episodes():
+                images, orders, rotations = take_images()
+                return tf.reshape(images, [batch_image_size, self.dim_input]), orders, rotations
+
+        if train:
+            self.metatrain_sampler = sampler
+            self.metatrain_start_cursor = cursor
+            self.metatrain_loader = loader
+        else:
+            self.metaval_sampler = sampler
+            self.metaval_start_cursor = cursor
+            self.metaval_loader = loader
+        return next_episodes
+
+    def make_episodes(self, images, orders, rotations):
+        """ Shuffle the classes of every task of a meta-batch, and label its images
+
+        The shuffles and rotations are drawn by the episode sampler (see EpisodeSampler.presentation), so a
+        task is presented the same way whenever it is sampled again, e.g. after resuming training.
+
+        Args:
+            images:     Tensor with the images of one meta-batch, of shape [batch_size*num_classes*num_samples_per_class, dim_input],
+                        ordered by task and within a task by class
+            orders:     Integer tensor of shape [batch_size, num_samples_per_class, num_classes], for every task and shot the order of its classes
+            rotations:  Integer tensor of shape [batch_size, num_classes], the quarter turns of every class of every task (omniglot only)
+
+        returns:
+            tuple (images of shape [batch_size, num_classes*num_samples_per_class, dim_input], one hot labels)
+        """
+        examples_per_batch = self.num_classes * self.num_samples_per_class # amount of examples in task
+
+        print('Manipulating image data to be right shape')
+        # within a task, sample k of class c sits at c*num_samples_per_class + k. For every task and every shot k
+        # the classes are taken in the sampled order, all with one op: class_idxs has shape [batch_size, num_samples_per_class, num_classes]
+        images = tf.reshape(images, [self.batch_size, examples_per_batch, self.dim_input])
+        class_idxs = orders
+        true_idxs = class_idxs*self.num_samples_per_class + tf.reshape(tf.range(self.num_samples_per_class), [1, -1, 1])
+        true_idxs = tf.reshape(true_idxs, [self.batch_size, examples_per_batch])
+        batch_idxs = tf.tile(tf.expand_dims(tf.range(self.batch_size), 1), [1, examples_per_batch])
+        all_image_batches = tf.gather_nd(images, tf.stack([batch_idxs, true_idxs], axis=2)) # has shape [self.batch_size, self.num_samples_per_class*self.num_classes, self.dim_input]
+        all_label_batches = tf.reshape(class_idxs, [self.batch_size, examples_per_batch]) # the label of an image is its class index
+
+        if FLAGS.datasource == 'omniglot' and not FLAGS.packed_data:
+            # omniglot augments the dataset by rotating digits to create new classes
+            # the sampled rotation per class per task (e.g. 0,1,2,0,0 if there are 5 classes), rotate all images with one op
+            image_rotations = tf.reshape(tf.gather_nd(rotations, tf.stack([batch_idxs, all_label_batches], axis=2)), [-1])
+            flat_images = tf.reshape(all_image_batches, [-1, self.img_size[0], self.img_size[1], 1])
+            rotated_images = tf.stack([flat_images,
+                tf.transpose(tf.reverse(flat_images, [2]), [0, 2, 1, 3]), # rot90, k=1
+                tf.reverse(flat_images, [1, 2]),                           # rot90, k=2
+                tf.reverse(tf.transpose(flat_images, [0, 2, 1, 3]), [2])]) # rot90, k=3
+            image_idxs = tf.range(tf.shape(flat_images)[0])
+            all_image_batches = tf.reshape(tf.gather_nd(rotated_images, tf.stack([image_rotations, image_idxs], axis=1)),
+                [self.batch_size, examples_per_batch, self.dim_input])
+        all_label_batches = tf.one_hot(all_label_batches, self.num_classes) # Do one hot conversion for cross-entropy loss
+        return all_image_batches, all_label_batches
+
+    def close(self):
+        """ Stop the episode loader workers of the input pipelines, if any (see EpisodeLoader.close) """
+        for loader in [getattr(self, 'metatrain_loader', None), getattr(self, 'metaval_loader', None)]:
+            if loader is not None:
+                loader.close()
+
+    def sinusoid_buffers(self):
+        """ Return newly allocated (inputs, outputs, amplitudes, phases) arrays for one meta-batch of sinusoid tasks """
+        return (np.zeros([self.batch_size, self.num_samples_per_class, self.dim_input]),
+                np.zeros([self.batch_size, self.num_samples_per_class, self.dim_output]),
+                np.zeros([self.batch_size]),
+                np.zeros([self.batch_size]))
+
+    def generate_sinusoid_batch(self, input_idx=None, rng=np.random, out=None):
+        """ Draw a meta-batch of sinusoid regression tasks with a few vectorized numpy calls
+
+        Task i is the function amp[i] * sin(x - phase[i]), evaluated at num_samples_per_class points x
+        drawn uniformly from input_range. Amplitudes and phases are drawn uniformly from their ranges.
+
+        Args:
+            input_idx:  Integer, if not None the points from input_idx on are evenly spaced over input_range (e.g. for plotting)
+            rng:        numpy RandomState (or the np.random module) the tasks are drawn from
+            out:        Tuple of arrays as returned by sinusoid_buffers to write the meta-batch into, newly allocated if None
+
+        returns:
+            tuple (inputs [batch_size, num_samples_per_class, 1], outputs [batch_size, num_samples_per_class, 1], amplitudes [batch_size], phases [batch_size])
+        """
+        inputs, outputs, amp, phase = self.sinusoid_buffers() if out is None else out
+        amp[:] = rng.uniform(self.amp_range[0], self.amp_range[1], self.batch_size)
+        phase[:] = rng.uniform(self.phase_range[0], self.phase_range[1], self.batch_size)
+        inputs[:] = rng.uniform(self.input_range[0], self.input_range[1], inputs.shape)
+        if input_idx is not None:
+            inputs[:, input_idx:, 0] = np.linspace(self.input_range[0], self.input_range[1], num=self.num_samples_per_class-input_idx)
+        np.subtract(inputs, phase[:, None, None], out=outputs)
+        np.sin(outputs, out=outputs)
+        outputs *= amp[:, None, None]
+        return inputs, outputs, amp, phase
+
+    def generate_sinusoid(self, train=True, input_idx=None):
+        """ Return a meta-batch of sinusoid tasks, see generate_sinusoid_batch
+
+        Meta-train batches come from the prefetching thread. With preallocate, the returned arrays are
+        reused buffers, only valid until the next call with train=True.
+        Meta-val batches (and batches with input_idx) are drawn on the spot from np.random, so seeding
+        np.random makes them reproducible.
+        """
+        if not train or input_idx is not None or self.prefetch == 0:
+            return self.generate_sinusoid_batch(input_idx)
+
+        if self.prefetch_thread is None:
+            if self.preallocate:
+                # prefetched buffers plus the one held by the caller
+                self.free_buffers = queue.Queue()
+                for i in range(self.prefetch + 1):
+                    self.free_buffers.put(self.sinusoid_buffers())
+                self.prefetched = queue.Queue()
+            else:
+                self.free_buffers = None
+                self.prefetched = queue.Queue(maxsize=self.prefetch)
+            rng = np.random.RandomState(np.random.randint(2**31 - 1))
+            self.prefetch_thread = threading.Thread(target=self._prefetch_sinusoid, args=(rng,))
+            self.prefetch_thread.daemon = True
+            self.prefetch_thread.start()
+
+        if self.held_buffer is not None:
+            self.free_buffers.put(self.held_buffer)
+        batch = self.prefetched.get()
+        if self.preallocate:
+            self.held_buffer = batch
+        return batch
+
+    def _prefetch_sinusoid(self, rng):
+        while True:
+            out = self.free_buffers.get() if self.free_buffers is not None else None
+            self.prefetched.put(self.generate_sinusoid_batch(rng=rng, out=out))
+
+    def decode_image(self, image_file):
+        """ Decode the contents of one image file into a flat float image in [0, 1] """
         if FLAGS.datasource == 'miniimagenet' or FLAGS.datasource == 'cifarfs':
             image = tf.image.decode_jpeg(image_file, channels=3)
             image.set_shape((self.img_size[0],self.img_size[1],3))
@@ -115,50 +432,88 @@ class DataGenerator(object):
             image = tf.reshape(image, [self.dim_input])
             image = tf.cast(image, tf.float32) / 255.0
             image = 1.0 - image  # invert
-        
-        num_preprocess_threads = 1 # TODO - enable this to be set to >1
-        min_queue_examples = 256
-        examples_per_batch = self.num_classes * self.num_samples_per_class # amount of examples in task
-        batch_image_size = self.batch_size  * examples_per_batch # amount of examples in batch of tasks
-        print('Batching images')
-        images = tf.train.batch(
-                [image],
-                batch_size = batch_image_size,
-                num_threads=num_preprocess_threads,
-                capacity=min_queue_examples + 3 * batch_image_size,
-                )# TODO why 3*batch_image_size?!
-        all_image_batches, all_label_batches = [], []
-        print('Manipulating image data to be right shape')
-        for i in range(self.batch_size): # self.batch_size = amount of tasks per batch
-            image_batch = images[i*examples_per_batch:(i+1)*examples_per_batch]
-
-            if FLAGS.datasource == 'omniglot':
-                # omniglot augments the dataset by rotating digits to create new classes
-                # get rotation per class (e.g. 0,1,2,0,0 if there are 5 classes)
-                rotations = tf.multinomial(tf.log([[1., 1.,1.,1.]]), self.num_classes)
-                
-            label_batch = tf.convert_to_tensor(labels)
-            new_list, new_label_list = [], []
-            for k in range(self.num_samples_per_class):
-                class_idxs = tf.range(0, self.num_classes)
-                class_idxs = tf.random_shuffle(class_idxs)
-
-                true_idxs = class_idxs*self.num_samples_per_class + k
-                new_list.append(tf.gather(image_batch,true_idxs))
-                
-                # rotate if omniglot
-                if FLAGS.datasource == 'omniglot': # and FLAGS.train:
-                    new_list[-1] = tf.stack([tf.reshape(tf.image.rot90(
-                        tf.reshape(new_list[-1][ind], [self.img_size[0],self.img_size[1],1]),
-                        k=tf.cast(rotations[0,class_idxs[ind]], tf.int32)), (self.dim_input,))
-                        for ind in range(self.num_classes)])
-                
-                new_label_list.append(tf.gather(label_batch, true_idxs))
-            new_list = tf.concat(new_list, 0)  # has shape [self.num_classes*self.num_samples_per_class, self.dim_input]
-            new_label_list = tf.concat(new_label_list, 0)
-            all_image_batches.append(new_list)
-            all_label_batches.append(new_label_list)
-        all_image_batches = tf.stack(all_image_batches)
-        all_label_batches = tf.stack(all_label_batches)
-        all_label_batches = tf.one_hot(all_label_batches, self.num_classes) # Do one hot conversion for cross-entropy loss
-        return all_image_batches, all_label_batches
\ No newline at end of file
+        return image
+
+class EpisodeSampler(object):
+    """ Samples the image indices of tasks (episodes) on demand
+
+    Episode i, and its presentation, are drawn from random generators seeded with (seed, i), so every
+    episode can be regenerated from the seed and its position alone. Startup is constant-time, memory does not
+    grow with the number of sampled episodes, and sampling resumes exactly by restoring the cursor.
+
+    Attributes:
+        offsets:        Array of integers, the images of class c have indices offsets[c] up to offsets[c+1]
+        seed:           Integer seed of the sampler
+        num_episodes:   Integer number of distinct episodes which are cycled through, None for no bound
+        cycle_length:   Integer number of episode positions after which the episodes repeat, at least num_episodes
+        cursor:         Integer index of the next episode to be returned by next_batch
+    """
+    def __init__(self, class_sizes, num_classes, num_samples_per_class, seed=0, num_episodes=None, cursor=0, cycle_length=None):
+        """
+        Args:
+            class_sizes:            List of integers with the number of images of each class of the split
+            num_classes:            Integer number of classes per episode (N-way)
+            num_samples_per_class:  Integer number of images per class per episode
+            seed:                   Integer seed of the sampler
+            num_episodes:           Integer number of distinct episodes which are cycled through, None for no bound
+            cursor:                 Integer index of the first episode to be returned
+            cycle_length:           Integer number of episode positions after which the episodes repeat, num_episodes if None.
+                                    The positions from num_episodes up to cycle_length repeat the first episodes, e.g. to
+                                    fill the last meta-batch of a cycle so every cycle starts at a meta-batch
+        """
+        self.class_sizes = np.asarray(class_sizes, dtype=np.int64)
+        self.offsets = np.concatenate([[0], np.cumsum(self.class_sizes)])
+        self.num_classes = num_classes
+        self.num_samples_per_class = num_samples_per_class
+        self.seed = seed
+        self.num_episodes = num_episodes
+        self.cycle_length = cycle_length or num_episodes
+        self.cursor = cursor
+        self.lock = threading.Lock()
+
+    def episode(self, index):
+        """ Sample episode number index
+
+        returns:
+            integer array of shape [num_classes, num_samples_per_class] with the global image indices,
+            row j holds the images of the class that gets label j
+        """
+        rng = np.random.RandomState([self.seed, self.position(index)])
+        classes = rng.choice(len(self.class_sizes), self.num_classes, replace=False)
+        samples = np.array([rng.choice(self.class_sizes[c], self.num_samples_per_class, replace=False) for c in classes])
+        return self.offsets[classes][:, None] + samples
+
+    def presentation(self, index):
+        """ Sample how episode number index is presented, from a generator apart from the one of episode(index)
+
+        returns:
+            tuple (integer array of shape [num_samples_per_class, num_classes], for every shot the order in which the rows
+            of the episode are presented, integer array of shape [num_classes] with the quarter turns of every row)
+        """
+        rng = np.random.RandomState([self.seed, self.position(index), 1])
+        orders = np.argsort(rng.random_sample((self.num_samples_per_class, self.num_classes)), axis=1)
+        rotations = rng.randint(4, size=self.num_classes)
+        return orders, rotations
+
+    def presentations(self, start, batch_size):
+        """ Return the presentations of episodes start up to start+batch_size, as int32 arrays of shape
+        [batch_size, num_samples_per_class, num_classes] and [batch_size, num_classes] """
+        orders, rotations = zip(*[self.presentation(i) for i in range(start, start + batch_size)])
+        return np.stack(orders).astype(np.int32), np.stack(rotations).astype(np.int32)
+
+    def position(self, index):
+        """ Return the index of the distinct episode at position index """
+        if self.num_episodes is not None:
+            index = index % self.cycle_length % self.num_episodes
+        return index
+
+    def next_batch(self, batch_size, presentation=False):
+        """ Return the next batch_size episodes, as an array of shape [batch_size, num_classes, num_samples_per_class],
+        followed by their presentations (see presentations) if presentation is True """
+        with self.lock:
+            start = self.cursor
+            self.cursor += batch_size
+        indices = np.stack([self.episode(i) for i in range(start, start + batch_size)])
+        if presentation:
+            return (indices,) + self.presentations(start, batch_size)
+        return indices
@@ -0,0 +1,189 @@
+"""
+Code for evaluating a trained model on cached embeddings of the meta-val (or meta-test) split.
+
+The CNN is frozen at test time and every image of the split appears in many episodes, so every
+image is embedded once with forward_conv_CNN and the features are cached on disk, keyed by the
+checkpoint. Each episode then only needs its closed-form ridge regression, which is solved in
+numpy for many episodes at once, so evaluating thousands of episodes takes seconds.
+
+The split is embedded in class-sorted chunks, so with --norm=batch_norm the CNN would normalize
+every chunk with the statistics of about one class, a different feature space than the support or
+query set of an episode: the cache refuses batch norm. With layer_norm or None the features are
+identical to the per-episode evaluation, up to dropout: R2D2_paper applies dropout to the query
+images of an episode, also at test time, while the cached query features are computed without it.
+
+Usage Instructions:
+    python main.py --datasource=cifarfs --train=False --test_set=True --embedding_cache=True --num_test_episodes=10000 ...
+"""
+from __future__ import print_function
+import numpy as np
+import os
+import tensorflow as tf
+
+from data_generator import EpisodeSampler
+from tensorflow.python.platform import flags
+from utils import get_images, select_ridge_form
+
+FLAGS = flags.FLAGS
+
+EMBED_BATCH_SIZE = 500 # images embedded per session run
+EPISODE_CHUNK_FLOATS = 2**26 # bound on the gathered episode features solved at once (256 MB of float32)
+
+def cache_path(logdir, model_file, split_folder):
+    """ Return the path of the embedding cache of a split for a checkpoint
+
+    Args:
+        logdir:         String with the directory of the experiment, e.g. FLAGS.logdir + '/' + exp_string
+        model_file:     String with the path of the checkpoint the embeddings are computed with
+        split_folder:   String with the path to the split folder that is embedded
+
+    returns:
+        string with the path of the .npz cache file
+    """
+    split_name = os.path.basename(os.path.normpath(split_folder))
+    return os.path.join(logdir, 'embeddings.' + os.path.basename(model_file) + '.' + split_name + '.npz')
+
+def embed_split(sess, model, data_generator):
+    """ Embed every image of the meta-val split of data_generator with the CNN of model
+
+    Args:
+        sess:               TensorFlow session object, holding the restored weights
+        model:              Model object with a forward_conv_CNN function and weights
+        data_generator:     DataGenerator object of the split
+
+    returns:
+        tuple (float32 features of shape [num_images, dim] sorted by class, class offsets)
+    """
+    if FLAGS.packed_data:
+        store = data_generator.metaval_store
+        items, offsets, load_items = np.arange(len(store.images)), store.offsets, store.gather
+        inputs = tf.placeholder(tf.uint8, (None,) + store.image_shape)
+        images = tf.cast(tf.reshape(inputs, [-1, data_generator.dim_input]), tf.float32) / 255.0
+    else:
+        folders = data_generator.metaval_character_folders
+        labels_and_images = get_images(folders, range(len(folders)), shuffle=False, persist_manifest=data_generator.persist_manifest)
+        items, load_items = np.array([li[1].encode() for li in labels_and_images]), lambda items: items
+        offsets = np.concatenate([[0], np.cumsum(np.bincount([li[0] for li in labels_and_images], minlength=len(folders)))])
+        inputs = tf.placeholder(tf.string, [None])
+        images = tf.map_fn(lambda filename: data_generator.decode_image(tf.read_file(filename)), inputs, dtype=tf.float32, back_prop=False)
+
+    with tf.variable_scope('model', reuse=True):
+        features = model.forward_conv_CNN(images, model.weights, reuse=True)
+
+    embeddings = []
+    for start in range(0, len(items), EMBED_BATCH_SIZE):
+        embeddings.append(sess.run(features, {inputs: load_items(items[start:start + EMBED_BATCH_SIZE])}))
+        print('Embedded %d/%d images' % (min(start + EMBED_BATCH_SIZE, len(items)), len(items)))
+    return np.concatenate(embeddings).astype(np.float32), np.asarray(offsets, dtype=np.int64)
+
+def load_or_embed_split(sess, model, data_generator, path, model_file):
+    """ Load the cached embeddings at path, computing and caching them first if needed
+
+    A cache older than its checkpoint (e.g. the checkpoint was overwritten by a new run) is recomputed.
+
+    returns:
+        tuple (float32 features of shape [num_images, dim] sorted by class, class offsets)
+    """
+    if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(model_file + '.index'):
+        print('Loading cached embeddings from ' + path)
+        with np.load(path) as cache:
+            return cache['features'], cache['offsets']
+
+    features, offsets = embed_split(sess, model, data_generator)
+    with open(path + '.tmp', 'wb') as f:
+        np.savez(f, features=features, offsets=offsets)
+    os.rename(path + '.tmp', path)
+    print('Cached embeddings in ' + path)
+    return features, offsets
+
+def solve_ridge_systems(systems, rhs, solver):
+    """ Solve a batch of symmetric positive definite systems, the numpy counterpart of the solvers of utils.ridge_regression
+
+    Args:
+        systems:    Float array of shape [batch, n, n]
+        rhs:        Float array of shape [batch, n, o]
+        solver:     'inv' (explicit inverse) or 'cholesky' (Cholesky factorization and solves)
+
+    returns:
+        array of shape [batch, n, o]
+    """
+    if solver == 'cholesky':
+        chol = np.linalg.cholesky(systems)
+        return np.linalg.solve(chol.transpose(0, 2, 1), np.linalg.solve(chol, rhs))
+    elif solver == 'inv':
+        return np.matmul(np.linalg.inv(systems), rhs)
+    raise ValueError('Unrecognized ridge solver: ' + solver)
+
+def ridge_episode_accuracies(features, offsets, lr_weights, num_classes, num_shots, num_queries, num_episodes, seed=1):
+    """ Solve the ridge regression of every episode on cached features and return the accuracies
+
+    The form and solver of the ridge regression follow FLAGS.ridge_form and FLAGS.ridge_solver, as in the model.
+
+    Args:
+        features:       Float array of shape [num_images, dim], sorted by class
+        offsets:        Integer array, the features of class c are features[offsets[c]:offsets[c+1]]
+        lr_weights:     Dictionary with the numpy values of 'stop_w5', 'lr_lambda', 'lr_alpha' and 'lr_beta'
+        num_classes:    Integer number of classes per episode (N-way)
+        num_shots:      Integer number of support images per class (K-shot)
+        num_queries:    Integer number of query images per class
+        num_episodes:   Integer number of episodes to evaluate
+        seed:           Integer seed of the episode sampler
+
+    returns:
+        array of shape [num_episodes, 2] with the support accuracy of the meta-learned linear layer,
+        and the query accuracy after the ridge regression (as the columns of test() in main.py)
+    """
+    sampler = EpisodeSampler(np.diff(offsets), num_classes, num_shots + num_queries, seed=seed, num_episodes=num_episodes)
+    alpha, beta, lr_lambda = lr_weights['lr_alpha'], lr_weights['lr_beta'], lr_weights['lr_lambda']
+    # rows of an episode are ordered by class, row block j holds the images with label j
+    labela = np.repeat(np.arange(num_classes), num_shots)
+    labelb = np.repeat(np.arange(num_classes), num_queries)
+    onehota = np.eye(num_classes, dtype=np.float32)[labela]
+
+    form = select_ridge_form(num_classes*num_shots, features.shape[1])
+    chunk = max(1, EPISODE_CHUNK_FLOATS // (num_classes*(num_shots + num_queries)*features.shape[1]))
+
+    accuracies = []
+    for start in range(0, num_episodes, chunk):
+        idxs = sampler.next_batch(min(chunk, num_episodes - start))
+        xa = features[idxs[:, :, :num_shots].reshape(len(idxs), -1)]
+        xb = features[idxs[:, :, num_shots:].reshape(len(idxs), -1)]
+
+        if form == 'primal':
+            gram = np.matmul(xa.transpose(0, 2, 1), xa) + lr_lambda*np.eye(xa.shape[2], dtype=np.float32)
+            w = solve_ridge_systems(gram, np.matmul(xa.transpose(0, 2, 1), onehota), FLAGS.ridge_solver)
+        else: # dual (Woodbury) form
+            gram = np.matmul(xa, xa.transpose(0, 2, 1)) + lr_lambda*np.eye(xa.shape[1], dtype=np.float32)
+            w = np.matmul(xa.transpose(0, 2, 1), solve_ridge_systems(gram, np.broadcast_to(onehota, (len(idxs),) + onehota.shape), FLAGS.ridge_solver))
+
+        outputa = alpha*np.matmul(xa, lr_weights['stop_w5']) + beta
+        outputb = alpha*np.matmul(xb, w) + beta
+        accuracies.append(np.stack([np.mean(np.argmax(outputa, 2) == labela, 1),
+                                    np.mean(np.argmax(outputb, 2) == labelb, 1)], 1))
+    return np.concatenate(accuracies)
+
+def evaluate(sess, model, data_generator, logdir, model_file, num_episodes):
+    """ Evaluate num_episodes episodes of the meta-val split on cached embeddings
+
+    Args:
+        sess:               TensorFlow session object, holding the restored weights
+        model:              Model object with a forward_conv_CNN function and weights
+        data_generator:     DataGenerator object of the split
+        logdir:             String with the directory of the experiment, the cache is stored there
+        model_file:         String with the path of the restored checkpoint
+        num_episodes:       Integer number of episodes to evaluate
+
+    returns:
+        array of shape [num_episodes, 2] with the accuracies, see ridge_episode_accuracies
+    """
+    if FLAGS.norm == 'batch_norm':
+        raise ValueError('The embedding cache does not support --norm=batch_norm: the split is embedded in class-sorted chunks, '
+                         'which batch norm would normalize with the statistics of about one class')
+    split_folder = os.path.dirname(data_generator.metaval_character_folders[0])
+    path = cache_path(logdir, model_file, split_folder)
+    features, offsets = load_or_embed_split(sess, model, data_generator, path, model_file)
+    lr_weights = sess.run({key: model.weights[key] for key in ['stop_w5', 'lr_lambda', 'lr_alpha', 'lr_beta']})
+    num_shots = FLAGS.update_batch_size
+    # the seed of the sampler of the test graph, so the same episodes are evaluated as by test()
+    return ridge_episode_accuracies(features, offsets, lr_weights, data_generator.num_classes, num_shots,
+                                    data_generator.num_samples_per_class - num_shots, num_episodes, seed=data_generator.metaval_sampler.seed)
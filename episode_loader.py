@@ -0,0 +1,145 @@
+"""
+Code for assembling meta-batches of episodes in worker processes.
+
+Each worker process takes a free slot of a ring buffer in shared memory, assembles the images of
+one meta-batch of episodes into it and hands the slot back to the training process, which reads
+the images straight out of shared memory. Episode production therefore scales with the number of
+workers instead of being bound to one Python thread in the training process.
+
+The meta-batches are returned in the order of the episode sampler, whichever worker finishes first,
+so training is reproducible for a given sampler seed. Labels are implicit: like for the other input
+pipelines, the images of an episode are ordered by class, and the labels are assigned in the graph in
+the order drawn by the sampler, see DataGenerator.make_episodes.
+
+The workers are forked after TensorFlow is imported, while the graph is built. They inherit the sampler,
+the load_images function and the shared-memory ring buffer through fork, so they are always started with
+the fork start method, whatever the default of the platform; where fork is unavailable (e.g. Windows)
+the workers pipeline raises an error and another input pipeline has to be used. Forking is safe because
+the workers never call TensorFlow, only numpy and the load_images function, and the fork happens before
+the session is created: no TensorFlow thread pool runs yet, so no lock can be copied in a held state.
+The workers are stopped by EpisodeLoader.close at the end of training or testing (see DataGenerator.close).
+"""
+from __future__ import print_function
+import ctypes
+import multiprocessing
+import numpy as np
+import queue
+import time
+
+def decode_files(filenames, img_size, channels=3):
+    """ Decode image files into one uint8 array of shape [len(filenames), height, width, channels] """
+    from PIL import Image
+
+    mode = 'RGB' if channels == 3 else 'L'
+    images = np.empty((len(filenames), img_size[0], img_size[1], channels), dtype=np.uint8)
+    for i, filename in enumerate(filenames):
+        images[i] = np.asarray(Image.open(filename).convert(mode), dtype=np.uint8).reshape(images.shape[1:])
+    return images
+
+def _worker(load_images, sampler, batch_size, slots, free_slots, filled_slots, next_batch):
+    """ Worker process loop: fill free slots with the next meta-batch, until a None slot is received """
+    while True:
+        slot = free_slots.get()
+        if slot is None:
+            return
+        with next_batch.get_lock():
+            batch = next_batch.value
+            next_batch.value += 1
+        start = sampler.cursor + batch * batch_size # the cursor of the worker's copy of the sampler is fixed
+        indices = np.stack([sampler.episode(i) for i in range(start, start + batch_size)])
+        slots[slot] = load_images(indices.reshape(-1))
+        filled_slots.put((batch, slot))
+
+class EpisodeLoader(object):
+    """ Pool of worker processes filling a shared-memory ring buffer with meta-batches of images
+
+    Attributes:
+        slots:          Array of shape [num_slots, batch images, height, width, channels] in shared memory
+        stall_time:     Float, seconds next_batch waited for a meta-batch since the last report
+        num_stalls:     Integer number of calls to next_batch which had to wait since the last report
+        num_batches:    Integer number of meta-batches returned since the last report
+    """
+    def __init__(self, load_images, sampler, batch_size, image_shape, num_workers=4, num_slots=None):
+        """
+        Args:
+            load_images:    Function mapping an integer array of global image indices to a uint8 array of images
+            sampler:        EpisodeSampler object, the episodes start at its current cursor
+            batch_size:     Integer number of episodes per meta-batch
+            image_shape:    Tuple (height, width, channels) of the images
+            num_workers:    Integer number of worker processes
+            num_slots:      Integer number of slots of the ring buffer, 2*num_workers if None
+        """
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            raise ValueError('The episode loader workers need the fork start method, which this platform does not have: '
+                             'use another --input_pipeline')
+        context = multiprocessing.get_context('fork')
+        self.sampler = sampler
+        self.batch_size = batch_size
+        num_slots = num_slots or 2 * num_workers
+        slot_shape = (batch_size * sampler.num_classes * sampler.num_samples_per_class,) + tuple(image_shape)
+
+        buffer = context.RawArray(ctypes.c_uint8, int(num_slots * np.prod(slot_shape)))
+        self.slots = np.frombuffer(buffer, dtype=np.uint8).reshape((num_slots,) + slot_shape)
+        self.free_slots = context.Queue()
+        self.filled_slots = context.Queue()
+        for slot in range(num_slots):
+            self.free_slots.put(slot)
+        next_batch = context.Value(ctypes.c_int64, 0)
+
+        # the workers are forked with a copy of the sampler, before the session starts any threads (see the module docstring)
+        self.workers = [context.Process(target=_worker, args=(load_images, sampler, batch_size, self.slots,
+                                                                      self.free_slots, self.filled_slots, next_batch))
+                        for _ in range(num_workers)]
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+
+        self.batch = 0 # index of the next meta-batch to return
+        self.pending = {} # filled slots of meta-batches which were finished ahead of their turn
+        self.held_slot = None # slot of the last returned meta-batch, released by the next call
+        self.stall_time, self.num_stalls, self.num_batches = 0., 0, 0
+
+    def next_batch(self):
+        """ Return the images of the next meta-batch, as a view on its slot in shared memory
+
+        The slot is handed back to the workers at the next call, so the returned array must be
+        consumed (e.g. copied into a tensor by tf.py_func) before then.
+        """
+        if self.held_slot is not None:
+            self.free_slots.put(self.held_slot)
+            self.held_slot = None
+
+        stalled = False
+        while self.batch not in self.pending:
+            try:
+                batch, slot = self.filled_slots.get(block=False)
+            except queue.Empty:
+                # no meta-batch is ready, the training process stalls until a worker is done
+                start_time = time.time()
+                batch, slot = self.filled_slots.get()
+                self.stall_time += time.time() - start_time
+                stalled = True
+            self.pending[batch] = slot
+        self.num_stalls += stalled
+
+        self.held_slot = self.pending.pop(self.batch)
+        self.batch += 1
+        self.num_batches += 1
+        self.sampler.cursor += self.batch_size # keep the cursor of the training process in sync, e.g. for checkpoints
+        return self.slots[self.held_slot]
+
+    def report_stalls(self):
+        """ Print how long the training process waited for the workers since the last report, and reset the counts """
+        print('Loader stalled on %d/%d meta-batches, %.1f ms per meta-batch' %
+              (self.num_stalls, self.num_batches, 1000 * self.stall_time / max(self.num_batches, 1)))
+        self.stall_time, self.num_stalls, self.num_batches = 0., 0, 0
+
+    def close(self, timeout=10):
+        """ Stop the worker processes, terminating those which do not finish their meta-batch within timeout seconds """
+        for _ in self.workers:
+            self.free_slots.put(None)
+        for worker in self.workers:
+            worker.join(timeout)
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
@@ -1,11 +1,11 @@
 """
 Usage Instructions:
     10-shot sinusoid:
-        python main.py --datasource=sinusoid --logdir=logs/sine/ --metatrain_iterations=70000 --norm=None --update_batch_size=10
+        python main.py --datasource=sinusoid --model=maml --logdir=logs/sine/ --metatrain_iterations=70000 --norm=None --update_batch_size=10
 
     10-shot sinusoid baselines:
-        python main.py --datasource=sinusoid --logdir=logs/sine/ --pretrain_iterations=70000 --metatrain_iterations=0 --norm=None --update_batch_size=10 --baseline=oracle
-        python main.py --datasource=sinusoid --logdir=logs/sine/ --pretrain_iterations=70000 --metatrain_iterations=0 --norm=None --update_batch_size=10
+        python main.py --datasource=sinusoid --model=maml --logdir=logs/sine/ --pretrain_iterations=70000 --metatrain_iterations=0 --norm=None --update_batch_size=10 --baseline=oracle
+        python main.py --datasource=sinusoid --model=maml --logdir=logs/sine/ --pretrain_iterations=70000 --metatrain_iterations=0 --norm=None --update_batch_size=10
 
     5-way, 1-shot omniglot:
         python main.py --datasource=omniglot --metatrain_iterations=40000 --meta_batch_size=32 --update_batch_size=1 --update_lr=0.4 --num_updates=1 --logdir=logs/omniglot5way/
@@ -26,20 +26,29 @@ Usage Instructions:
         python main.py --datasource=cifarfs --metatrain_iterations=60000 --meta_batch_size=4 --update_batch_size=5 --update_lr=0.01 --num_updates=5 --num_classes=5 --logdir=logs/cifarfs5shot/ --num_filters=32 --max_pool=True
         
     To run evaluation, use the '--train=False' flag and the '--test_set=True' flag to use the test set.
+    Add '--eval_batch_size=20' to evaluate 20 test episodes per session run, and '--num_test_episodes=10000' for tighter confidence intervals.
+    Add '--embedding_cache=True --num_test_episodes=10000' to evaluate many episodes on cached CNN features (see embedding_cache.py).
+    To validate out of band, train with '--inline_validation=False' and run the same command with '--validation_worker=True' next to it (see validate.py).
 
     For omniglot and miniimagenet training, acquire the dataset online, put it in the correspoding data directory, and see the python script instructions in that directory to preprocess the data.
     For CIFAR fs training, the dataset is automatically downloaded, and the splits are present in this code.
 """
 import csv
 import numpy as np
-import pickle
 import random
 import tensorflow as tf
+import time
 
+from checkpointing import AsyncSaver, load_training_state, restore_checkpoint, save_training_state
 from data_generator import DataGenerator
+from embedding_cache import evaluate as evaluate_embedding_cache
+from profiler import StepProfiler
+from replicas import Replicas
 from r2d2 import R2D2
-#from maml import MAML
+from maml import MAML
 from tensorflow.python.platform import flags
+from utils import report_input_wait, RunningStats, session_config
+from validate import run_validation_worker
 
 FLAGS = flags.FLAGS
 
@@ -48,6 +57,11 @@ flags.DEFINE_string('datasource', 'sinusoid', 'sinusoid or omniglot or miniimage
 flags.DEFINE_integer('num_classes', 5, 'number of classes used in classification (e.g. 5-way classification).')
 # oracle means task id is input (only suitable for sinusoid)
 flags.DEFINE_string('baseline', None, 'oracle, or None')
+flags.DEFINE_string('model', 'r2d2', 'r2d2 or maml, sinusoid needs maml (a fully connected network)')
+flags.DEFINE_bool('packed_data', False, 'if True, sample episodes from the memory-mapped arrays written by packed_data.py instead of decoding image files')
+flags.DEFINE_string('input_pipeline', 'queue', 'queue (queue runners), tf.data (parallel decode and prefetch) or workers (worker processes and a shared-memory ring buffer)')
+flags.DEFINE_integer('num_parallel_calls', 4, 'number of images decoded in parallel by the tf.data input pipeline')
+flags.DEFINE_integer('num_loader_workers', 4, 'number of worker processes assembling episodes with the workers input pipeline')
 
 ## Training options
 flags.DEFINE_integer('pretrain_iterations', 0, 'number of pre-training iterations.')
@@ -57,6 +71,9 @@ flags.DEFINE_float('meta_lr', 0.001, 'the base learning rate of the generator')
 flags.DEFINE_integer('update_batch_size', 5, 'number of examples used for inner gradient update (K for K-shot learning).')
 flags.DEFINE_float('update_lr', 1e-3, 'step size alpha for inner gradient update.') # 0.01 for miniImagenet (0.1 for omniglot)
 flags.DEFINE_integer('num_updates', 1, 'number of inner gradient updates during training.') # 5 inner gradient updates for miniImagenet
+flags.DEFINE_integer('num_replicas', 1, 'number of data-parallel replicas the meta-batch is split over, see replicas.py')
+flags.DEFINE_integer('replica_rank', 0, 'rank of this replica, replica 0 averages the gradients and writes summaries and checkpoints')
+flags.DEFINE_string('coordinator_address', 'localhost:47600', 'host:port on which replica 0 accepts the connections of the other replicas')
 
 ## Model options
 flags.DEFINE_string('norm', 'batch_norm', 'batch_norm, layer_norm, or None')
@@ -64,18 +81,31 @@ flags.DEFINE_integer('num_filters', 64, 'number of filters for conv nets -- 32 f
 flags.DEFINE_bool('conv', True, 'whether or not to use a convolutional network, only applicable in some cases')
 flags.DEFINE_bool('max_pool', False, 'Whether or not to use max pooling rather than strided convolutions') # True max pooling for miniImagenet
 flags.DEFINE_bool('stop_grad', False, 'if True, do not use second derivatives in meta-optimization (for speed)')
+flags.DEFINE_bool('batched_tasks', False, 'if True, run the CNN and the ridge regression for all tasks of the meta-batch at once instead of per task (batch norm statistics then span the meta-batch)')
+flags.DEFINE_string('ridge_solver', 'inv', 'inv (explicit inverse) or cholesky (Cholesky factorization and solve) for the closed-form ridge regression')
+flags.DEFINE_string('ridge_form', 'auto', 'dual (N*K x N*K system), primal (feature x feature system) or auto (the smaller one) for the closed-form ridge regression')
+flags.DEFINE_bool('xla', False, 'if True, compile the graph with the XLA JIT (also on CPU), most effective with --batched_tasks as the per-task loop is not compiled')
 
 ## Logging, saving, and testing options
 flags.DEFINE_bool('log', True, 'if false, do not log summaries, for debugging code.')
+flags.DEFINE_bool('report_input_wait', False, 'if True, report every print interval whether training is input-bound or compute-bound (traces one step per print interval).')
+flags.DEFINE_bool('profile', False, 'if True, report steps/sec, step latency percentiles and per-stage times while training, see profiler.py')
+flags.DEFINE_integer('profile_trace_interval', 1000, 'with --profile, capture a full Chrome trace every this many iterations (0 for never)')
 flags.DEFINE_string('logdir', '/tmp/data', 'directory for summaries and checkpoints.')
+flags.DEFINE_bool('async_checkpoint', False, 'if True, snapshot the weights in memory and write checkpoints from a background thread')
 flags.DEFINE_bool('resume', True, 'resume training if there is a model available')
 flags.DEFINE_bool('train', True, 'True to train, False to test.')
+flags.DEFINE_bool('inline_validation', True, 'if True, pause training every few print intervals to validate on one meta-batch')
+flags.DEFINE_bool('validation_worker', False, 'if True, validate every new checkpoint of the training run on all meta-val episodes, see validate.py')
 flags.DEFINE_integer('test_iter', -1, 'iteration to load model (-1 for latest model)')
 flags.DEFINE_bool('test_set', False, 'Set to true to test on the the test set, False for the validation set.')
+flags.DEFINE_bool('embedding_cache', False, 'if True, test by embedding the split once with the frozen CNN (cached per checkpoint) and solving the episodes on the cached features')
+flags.DEFINE_integer('num_test_episodes', 600, 'number of distinct episodes evaluated when testing')
+flags.DEFINE_integer('eval_batch_size', 1, 'number of test episodes evaluated per session run when testing')
 flags.DEFINE_integer('train_update_batch_size', -1, 'number of examples used for gradient update during training (use if you want to test with a different number).')
 flags.DEFINE_float('train_update_lr', -1, 'value of inner gradient step step during training. (use if you want to test with a different value)') # 0.1 for omniglot
 
-def train(model, saver, sess, exp_string, data_generator, resume_itr=0):
+def train(model, saver, sess, exp_string, data_generator, resume_itr=0, replicas=None):
     SUMMARY_INTERVAL = 100
     SAVE_INTERVAL = 1000
     if FLAGS.datasource == 'sinusoid':
@@ -85,12 +115,26 @@ def train(model, saver, sess, exp_string, data_generator, resume_itr=0):
         PRINT_INTERVAL = 100
         TEST_PRINT_INTERVAL = PRINT_INTERVAL*5 # print (1) test eval result only after the train results are printed 5 times
 
-    if FLAGS.log:
+    if resume_itr >= FLAGS.pretrain_iterations + FLAGS.metatrain_iterations:
+        # resumed from the final checkpoint, the checkpoint and training state of the last iteration already exist
+        print('Training already finished at iteration ' + str(resume_itr - 1))
+        return
+
+    is_chief = FLAGS.replica_rank == 0 # only one replica writes summaries and checkpoints
+    train_writer = None
+    if FLAGS.log and is_chief:
         train_writer = tf.summary.FileWriter(FLAGS.logdir + '/' + exp_string, sess.graph)
+    profiler = None
+    if FLAGS.profile:
+        images_per_step = data_generator.batch_size * data_generator.num_classes * data_generator.num_samples_per_class
+        profiler = StepProfiler(FLAGS.logdir + '/' + exp_string, FLAGS.profile_trace_interval, data_generator.batch_size, images_per_step)
     print('Done initializing, starting training.')
-    prelosses, postlosses = [], []
+    prelosses, postlosses, step_times = [], [], []
 
     num_classes = data_generator.num_classes # for classification, 1 otherwise
+    # episodes consumed so far, to resume from (the samplers themselves run ahead by the prefetched meta-batches)
+    train_cursor = getattr(data_generator, 'metatrain_start_cursor', 0)
+    val_cursor = getattr(data_generator, 'metaval_start_cursor', 0)
     multitask_weights, reg_weights = [], []
     
     # Start iterations from resume_itr if there is a training history
@@ -101,7 +145,7 @@ def train(model, saver, sess, exp_string, data_generator, resume_itr=0):
 
             if FLAGS.baseline == 'oracle': # NOTE - this flag is specific to sinusoid
                 batch_x = np.concatenate([batch_x, np.zeros([batch_x.shape[0], batch_x.shape[1], 2])], 2)
-                for i in range(FLAGS.meta_batch_size):
+                for i in range(batch_x.shape[0]):
                     batch_x[i, :, 1] = amp[i]
                     batch_x[i, :, 2] = phase[i]
             
@@ -128,12 +172,32 @@ def train(model, saver, sess, exp_string, data_generator, resume_itr=0):
                 input_tensors.extend([model.total_accuracy1, model.total_accuracies2[FLAGS.num_updates-1]])
         
         # Do one full meta train step
-        result = sess.run(input_tensors, feed_dict)
+        run_args = profiler.run_args(itr) if profiler is not None else {} # full trace every profile_trace_interval steps
+        if FLAGS.report_input_wait and itr % PRINT_INTERVAL == 0 and 'run_metadata' not in run_args:
+            # trace the step before a report, to measure how long it waits for its input
+            run_args = {'options': tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE), 'run_metadata': tf.RunMetadata()}
+        start_time = time.time()
+        if replicas is not None and itr >= FLAGS.pretrain_iterations:
+            # compute the gradients of this replica's tasks, average them over the replicas, then apply them
+            result = sess.run(model.replica_grads + input_tensors[1:], feed_dict, **run_args)
+            num_grads = len(model.replica_grads)
+            feed_dict.update(zip(model.replica_grad_placeholders, replicas.allreduce_mean(result[:num_grads])))
+            sess.run(model.metatrain_op, feed_dict)
+            result = [None] + result[num_grads:]
+        else:
+            result = sess.run(input_tensors, feed_dict, **run_args)
+        step_times.append(time.time() - start_time)
+        train_cursor += data_generator.batch_size
+        if profiler is not None:
+            profiler.record_step(itr, step_times[-1], run_args, train_writer)
 
         if itr % SUMMARY_INTERVAL == 0:
             prelosses.append(result[-2])
-            if FLAGS.log:
+            if FLAGS.log and is_chief:
+                start_time = time.time()
                 train_writer.add_summary(result[1], itr)
+                if profiler is not None:
+                    profiler.record_summary(time.time() - start_time)
             postlosses.append(result[-1])
 
         if (itr!=0) and itr % PRINT_INTERVAL == 0:
@@ -143,19 +207,27 @@ def train(model, saver, sess, exp_string, data_generator, resume_itr=0):
                 print_str = 'Iteration ' + str(itr - FLAGS.pretrain_iterations)
             print_str += ': ' + str(np.mean(prelosses)) + ', ' + str(np.mean(postlosses))
             print(print_str)
-            prelosses, postlosses = [], []
+            if FLAGS.report_input_wait and 'generate' not in dir(data_generator):
+                report_input_wait(run_args['run_metadata'], step_times)
+            if 'generate' not in dir(data_generator) and data_generator.metatrain_loader is not None:
+                data_generator.metatrain_loader.report_stalls()
+            if profiler is not None:
+                profiler.report(itr, train_writer)
+            prelosses, postlosses, step_times = [], [], []
 
         if (itr!=0) and itr % SAVE_INTERVAL == 0:
-            saver.save(sess, FLAGS.logdir + '/' + exp_string + '/model' + str(itr))
+            if is_chief:
+                saver.save(sess, FLAGS.logdir + '/' + exp_string + '/model' + str(itr))
+            save_training_state(FLAGS.logdir + '/' + exp_string + '/model' + str(itr), itr, train_cursor, val_cursor, FLAGS.replica_rank)
 
         # sinusoid is infinite data, so no need to test on meta-validation set.
-        if (itr!=0) and itr % TEST_PRINT_INTERVAL == 0 and FLAGS.datasource !='sinusoid':
+        if FLAGS.inline_validation and (itr!=0) and itr % TEST_PRINT_INTERVAL == 0 and FLAGS.datasource !='sinusoid':
             if 'generate' not in dir(data_generator):
-                feed_dict = {}
+                feed_dict = {model.use_metaval: True} # the training graph, fed a meta-validation batch
                 if model.classification:
-                    input_tensors = [model.metaval_total_accuracy1, model.metaval_total_accuracies2[FLAGS.num_updates-1], model.summ_op]
+                    input_tensors = [model.metaval_total_accuracy1, model.metaval_total_accuracies2[FLAGS.num_updates-1]]
                 else:
-                    input_tensors = [model.metaval_total_loss1, model.metaval_total_losses2[FLAGS.num_updates-1], model.summ_op]
+                    input_tensors = [model.metaval_total_loss1, model.metaval_total_losses2[FLAGS.num_updates-1]]
             else:
                 batch_x, batch_y, amp, phase = data_generator.generate(train=False)
                 inputa = batch_x[:, :num_classes*FLAGS.update_batch_size, :]
@@ -171,11 +243,18 @@ def train(model, saver, sess, exp_string, data_generator, resume_itr=0):
             # This session run is to evaluate
             result = sess.run(input_tensors, feed_dict)
             print('Validation results: ' + str(result[0]) + ', ' + str(result[1]))
-
-    saver.save(sess, FLAGS.logdir + '/' + exp_string +  '/model' + str(itr))
-
-# calculated for omniglot
-NUM_TEST_POINTS = 600
+            val_cursor += data_generator.batch_size
+            if FLAGS.log and is_chief and 'generate' not in dir(data_generator):
+                metric = 'accuracy' if model.classification else 'loss'
+                train_writer.add_summary(tf.Summary(value=[
+                    tf.Summary.Value(tag='metaval_Pre-update ' + metric, simple_value=result[0]),
+                    tf.Summary.Value(tag='metaval_Post-update %s, step %d' % (metric, FLAGS.num_updates), simple_value=result[1])]), itr)
+
+    if is_chief:
+        saver.save(sess, FLAGS.logdir + '/' + exp_string +  '/model' + str(itr))
+        if FLAGS.async_checkpoint:
+            saver.close() # wait for the background writes
+    save_training_state(FLAGS.logdir + '/' + exp_string +  '/model' + str(itr), itr, train_cursor, val_cursor, FLAGS.replica_rank)
 
 def test(model, saver, sess, exp_string, data_generator, test_num_updates=None):
     num_classes = data_generator.num_classes # for classification, 1 otherwise
@@ -183,10 +262,17 @@ def test(model, saver, sess, exp_string, data_generator, test_num_updates=None):
     np.random.seed(1)
     random.seed(1)
 
-    metaval_accuracies = []
-    metaval_labels = []
-
-    for _ in range(NUM_TEST_POINTS): # NUM_TEST_POINTS = amount of test tasks
+    # the results of every episode are streamed to disk, only running statistics are kept in memory
+    out_prefix = FLAGS.logdir +'/'+ exp_string + '/' + 'test_ubs' + str(FLAGS.update_batch_size) + '_stepsize' + str(FLAGS.update_lr)
+    stats = RunningStats()
+    label_sums = [0, 0]
+    episodes_file = open(out_prefix + '_episodes.csv', 'w')
+    episodes_writer = csv.writer(episodes_file, delimiter=',')
+    episodes_writer.writerow(['episode'] + ['update'+str(i) for i in range(1 + len(model.test_accuraciesb))])
+
+    # the episodes are drawn in the order of the seeded sampler, so they do not depend on the evaluation batch size
+    episode = 0
+    while episode < FLAGS.num_test_episodes:
         if 'generate' not in dir(data_generator):
             feed_dict = {}
             feed_dict = {model.meta_lr : 0.0}
@@ -195,8 +281,8 @@ def test(model, saver, sess, exp_string, data_generator, test_num_updates=None):
 
             if FLAGS.baseline == 'oracle': # NOTE - this flag is specific to sinusoid
                 batch_x = np.concatenate([batch_x, np.zeros([batch_x.shape[0], batch_x.shape[1], 2])], 2)
-                batch_x[0, :, 1] = amp[0]
-                batch_x[0, :, 2] = phase[0]
+                batch_x[:, :, 1] = np.reshape(amp, [-1, 1])
+                batch_x[:, :, 2] = np.reshape(phase, [-1, 1])
 
             inputa = batch_x[:, :num_classes*FLAGS.update_batch_size, :]
             inputb = batch_x[:,num_classes*FLAGS.update_batch_size:, :]
@@ -204,38 +290,47 @@ def test(model, saver, sess, exp_string, data_generator, test_num_updates=None):
             labelb = batch_y[:,num_classes*FLAGS.update_batch_size:, :]
 
             feed_dict = {model.inputa: inputa, model.inputb: inputb,  model.labela: labela, model.labelb: labelb, model.meta_lr: 0.0}
-        """
-        if model.classification:
-            #result = sess.run([model.test_accuraciesa] + model.test_accuraciesb, feed_dict)
-            result = sess.run([model.metaval_total_accuracy1] + model.metaval_total_accuracies2, feed_dict)
-        else:  # this is for sinusoid
-            result = sess.run([model.metaval_total_loss1] +  model.metaval_total_losses2, feed_dict)
-        metaval_accuracies.append(result)
-        """
-        result = sess.run([model.test_accuraciesa] + model.test_accuraciesb, feed_dict)
-        #result = sess.run([model.test_outputas] + model.test_outputbs, feed_dict)
-        labelas, labelbs = sess.run([model.labelas, model.labelbs], feed_dict)
-        metaval_accuracies.append(result)
-        metaval_labels.append([labelas, labelbs])
-
-    metaval_accuracies = np.array(metaval_accuracies)
-    #metaval_accuracies = np.array(metaval_accuracies[500])
-    #metaval_labels = np.array(metaval_labels[500])
-    metaval_labels = np.sum(np.array(metaval_labels), axis=0)
+        # a single run per episode, so the labels belong to the same (dequeued) episode as the accuracies
+        result = sess.run([model.test_accuraciesa] + model.test_accuraciesb + [model.labelas, model.labelbs], feed_dict)
+        labelas, labelbs = result[-2:]
+        label_sums = [label_sums[0] + np.sum(labelas, 0), label_sums[1] + np.sum(labelbs, 0)]
+        result = np.array(result[:-2]) # [updates, tasks of the meta-batch]
+        # the tasks of the last meta-batch beyond num_test_episodes are dropped
+        for task in range(min(result.shape[1], FLAGS.num_test_episodes - episode)):
+            stats.update(result[:, task])
+            episodes_writer.writerow([episode] + list(result[:, task]))
+            episode += 1
+
+    episodes_file.close()
+
+    means = stats.mean
+    stds = stats.std()
+    ci95 = stats.ci95()
     
+    print(label_sums)
+    print('Mean validation accuracy/loss, stddev, and confidence intervals')
+    print((means, stds, ci95))
+
+    out_filename = out_prefix + '.csv'
+    with open(out_filename, 'w') as f:
+        writer = csv.writer(f, delimiter=',')
+        writer.writerow(['update'+str(i) for i in range(len(means))])
+        writer.writerow(means)
+        writer.writerow(stds)
+        writer.writerow(ci95)
+
+def test_embedding_cache(model, sess, exp_string, data_generator, model_file):
+    if 'generate' in dir(data_generator) or model_file is None:
+        raise ValueError('Testing on cached embeddings needs an image dataset and a trained model')
+    metaval_accuracies = evaluate_embedding_cache(sess, model, data_generator, FLAGS.logdir + '/' + exp_string, model_file, FLAGS.num_test_episodes)
+
     means = np.mean(metaval_accuracies, 0)
     stds = np.std(metaval_accuracies, 0)
-    ci95 = 1.96*stds/np.sqrt(NUM_TEST_POINTS)
-    
-    #print(metaval_accuracies)
-    print(metaval_labels)
-    print('Mean validation accuracy/loss, stddev, and confidence intervals')
+    ci95 = 1.96*stds/np.sqrt(FLAGS.num_test_episodes)
+    print('Mean validation accuracy/loss, stddev, and confidence intervals (%d episodes on cached embeddings)' % FLAGS.num_test_episodes)
     print((means, stds, ci95))
 
-    out_filename = FLAGS.logdir +'/'+ exp_string + '/' + 'test_ubs' + str(FLAGS.update_batch_size) + '_stepsize' + str(FLAGS.update_lr) + '.csv'
-    out_pkl = FLAGS.logdir +'/'+ exp_string + '/' + 'test_ubs' + str(FLAGS.update_batch_size) + '_stepsize' + str(FLAGS.update_lr) + '.pkl'
-    with open(out_pkl, 'wb') as f:
-        pickle.dump({'mses': metaval_accuracies}, f)
+    out_filename = FLAGS.logdir +'/'+ exp_string + '/' + 'test_cached_ubs' + str(FLAGS.update_batch_size) + '_episodes' + str(FLAGS.num_test_episodes) + '.csv'
     with open(out_filename, 'w') as f:
         writer = csv.writer(f, delimiter=',')
         writer.writerow(['update'+str(i) for i in range(len(means))])
@@ -243,7 +338,44 @@ def test(model, saver, sess, exp_string, data_generator, test_num_updates=None):
         writer.writerow(stds)
         writer.writerow(ci95)
 
+def experiment_string():
+    # cls = no of classes
+    # mbs = meta batch size
+    # ubs = update batch size
+    # numstep = number of INNER GRADIENT updates
+    # updatelr = inner gradient step
+    exp_string = 'cls_'+str(FLAGS.num_classes)+'.mbs_'+str(FLAGS.meta_batch_size) + '.ubs_' + str(FLAGS.train_update_batch_size) + '.numstep' + str(FLAGS.num_updates) + '.updatelr' + str(FLAGS.train_update_lr)
+
+    if FLAGS.num_filters != 64:
+        exp_string += 'hidden' + str(FLAGS.num_filters)
+    if FLAGS.max_pool:
+        exp_string += 'maxpool'
+    if FLAGS.stop_grad:
+        exp_string += 'stopgrad'
+    if FLAGS.baseline:
+        exp_string += FLAGS.baseline
+    if FLAGS.model == 'maml':
+        exp_string += 'maml'
+    if FLAGS.norm == 'batch_norm':
+        exp_string += 'batchnorm'
+    elif FLAGS.norm == 'layer_norm':
+        exp_string += 'layernorm'
+    elif FLAGS.norm == 'None':
+        exp_string += 'nonorm'
+    else:
+        print('Norm setting not recognized.')
+    return exp_string
+
 def main():
+    if FLAGS.model not in ('r2d2', 'maml'):
+        raise ValueError('Unrecognized model: ' + FLAGS.model)
+    if FLAGS.datasource == 'sinusoid' and FLAGS.model != 'maml':
+        raise ValueError('R2D2 has no fully connected network for the sinusoid regression, use --model=maml')
+    if FLAGS.model == 'maml' and FLAGS.num_replicas > 1:
+        raise ValueError('Data-parallel replicas are only implemented for R2D2')
+    if FLAGS.train and FLAGS.num_replicas > 1 and FLAGS.pretrain_iterations > 0:
+        # only the gradients of the meta-train step are averaged over the replicas, pretraining would let their weights drift apart
+        raise ValueError('Data-parallel replicas do not support pretraining, use --pretrain_iterations=0')
     if FLAGS.datasource == 'sinusoid':
         if FLAGS.train:
             test_num_updates = 5 # During base-testing (and thus meta updating) 5 updates are used
@@ -262,10 +394,31 @@ def main():
         else:
             test_num_updates = 10 # Omniglot gets 10 updates during training AND testing
 
+    if FLAGS.train_update_batch_size == -1:
+        FLAGS.train_update_batch_size = FLAGS.update_batch_size
+    if FLAGS.train_update_lr == -1:
+        FLAGS.train_update_lr = FLAGS.update_lr
+    exp_string = experiment_string()
+
+    # the positions of the episode samplers are needed to build the input pipeline, so resuming starts here
+    training_state = None
+    if FLAGS.train and FLAGS.resume and not FLAGS.validation_worker:
+        model_file = tf.train.latest_checkpoint(FLAGS.logdir + '/' + exp_string)
+        if model_file:
+            training_state = load_training_state(model_file, FLAGS.replica_rank)
+    metatrain_cursor = training_state['metatrain_cursor'] if training_state else 0
+    metaval_cursor = training_state['metaval_cursor'] if training_state else 0
+
+    if FLAGS.train and FLAGS.num_replicas > 1:
+        assert FLAGS.meta_batch_size % FLAGS.num_replicas == 0
+        orig_meta_batch_size = FLAGS.meta_batch_size
+        # every replica builds its graph for its share of the tasks of the meta-batch
+        FLAGS.meta_batch_size = FLAGS.meta_batch_size // FLAGS.num_replicas
+
     if FLAGS.train == False:
         orig_meta_batch_size = FLAGS.meta_batch_size
-        # always use meta batch size of 1 when testing.
-        FLAGS.meta_batch_size = 1
+        # the test graph evaluates eval_batch_size episodes per run
+        FLAGS.meta_batch_size = FLAGS.eval_batch_size
 
     if FLAGS.datasource == 'sinusoid':
         # DataGenerator(num_samples_per_class, batch_size, config={})
@@ -280,7 +433,7 @@ def main():
                 if FLAGS.train: # TODO: why +15 and *2 --> followin Ravi: "15 examples per class were used for evaluating the post-update meta-gradient" = MAML algo 2, line 10 --> see how 5 and 15 is split up in maml.py?
                     # DataGenerator(number_of_images_per_class, number_of_tasks_in_batch)
                     data_generator = DataGenerator(FLAGS.update_batch_size+15, FLAGS.meta_batch_size)  # only use one datapoint for testing to save memory
-                else: # we're in the testing phase (not train), FLAGS.meta_batch_size = 1
+                else: # we're in the testing phase (not train), FLAGS.meta_batch_size = FLAGS.eval_batch_size
                     data_generator = DataGenerator(FLAGS.update_batch_size*2, FLAGS.meta_batch_size)  # only use one datapoint for testing to save memory
             else: # this is for omniglot
                 data_generator = DataGenerator(FLAGS.update_batch_size*2, FLAGS.meta_batch_size)  # only use one datapoint for testing to save memory
@@ -299,76 +452,56 @@ def main():
         tf_data_load = True
         num_classes = data_generator.num_classes
 
-        if FLAGS.train: # only construct training model if needed
-            # meta train : num_total_batches = 200000 (number of tasks, not number of meta-iterations)
-            random.seed(5)
-            image_tensor, label_tensor = data_generator.make_data_tensor()
-            inputa = tf.slice(image_tensor, [0,0,0], [-1,num_classes*FLAGS.update_batch_size, -1]) # slice(tensor, begin, slice_size)
-            inputb = tf.slice(image_tensor, [0,num_classes*FLAGS.update_batch_size, 0], [-1,-1,-1]) # The extra 15 add here?!
-            labela = tf.slice(label_tensor, [0,0,0], [-1,num_classes*FLAGS.update_batch_size, -1])
-            labelb = tf.slice(label_tensor, [0,num_classes*FLAGS.update_batch_size, 0], [-1,-1,-1])
-            input_tensors = {'inputa': inputa, 'inputb': inputb, 'labela': labela, 'labelb': labelb}
-
+        # meta train : num_total_batches = 200000 (number of tasks, not number of meta-iterations)
+        random.seed(5 + FLAGS.replica_rank) # replicas sample different tasks
+        metatrain_seed = random.randint(0, 2**31 - 1)
         # meta val: num_total_batches = 600 (number of tasks, not number of meta-iterations)
         random.seed(6)
-        image_tensor, label_tensor = data_generator.make_data_tensor(train=False)
-        inputa = tf.slice(image_tensor, [0,0,0], [-1,num_classes*FLAGS.update_batch_size, -1]) # slice the training examples here
-        inputb = tf.slice(image_tensor, [0,num_classes*FLAGS.update_batch_size, 0], [-1,-1,-1]) 
+        metaval_seed = random.randint(0, 2**31 - 1)
+        with tf.name_scope('input'): # the input stage of the profiler
+            if FLAGS.train and not FLAGS.validation_worker:
+                # a single model graph for meta-training and meta-validation, use_metaval switches the split it is fed from
+                use_metaval = tf.placeholder_with_default(False, (), name='use_metaval')
+                image_tensor, label_tensor = data_generator.make_switched_data_tensor(use_metaval, metatrain_seed, metatrain_cursor,
+                                                                                      metaval_seed, metaval_cursor)
+            else: # only construct the meta-validation model
+                image_tensor, label_tensor = data_generator.make_data_tensor(train=False, seed=metaval_seed, cursor=metaval_cursor,
+                                                                             num_episodes=600 if FLAGS.train else FLAGS.num_test_episodes)
+        inputa = tf.slice(image_tensor, [0,0,0], [-1,num_classes*FLAGS.update_batch_size, -1]) # slice(tensor, begin, slice_size)
+        inputb = tf.slice(image_tensor, [0,num_classes*FLAGS.update_batch_size, 0], [-1,-1,-1])
         labela = tf.slice(label_tensor, [0,0,0], [-1,num_classes*FLAGS.update_batch_size, -1])
         labelb = tf.slice(label_tensor, [0,num_classes*FLAGS.update_batch_size, 0], [-1,-1,-1])
-        metaval_input_tensors = {'inputa': inputa, 'inputb': inputb, 'labela': labela, 'labelb': labelb}
+        input_tensors = {'inputa': inputa, 'inputb': inputb, 'labela': labela, 'labelb': labelb}
     else:
         tf_data_load = False
         input_tensors = None
 
-    model = R2D2(dim_input, dim_output, test_num_updates=test_num_updates) # test_num_updates = eval on at least one update for training, 10 testing
-    if FLAGS.train or not tf_data_load:
+    if FLAGS.model == 'maml':
+        model = MAML(dim_input, dim_output, test_num_updates=test_num_updates)
+    else: # test_num_updates = eval on at least one update for training, 10 testing
+        model = R2D2(dim_input, dim_output, test_num_updates=test_num_updates)
+    if FLAGS.train and not FLAGS.validation_worker:
         model.construct_model(input_tensors=input_tensors, prefix='metatrain_')
-    if tf_data_load:
-        model.construct_model(input_tensors=metaval_input_tensors, prefix='metaval_')
+        if tf_data_load:
+            model.use_metaval = use_metaval
+    else:
+        model.construct_model(input_tensors=input_tensors, prefix='metaval_')
     
     # Op to retrieve summaries?
     model.summ_op = tf.summary.merge_all()
     
-    # keep last 10 copies of trainable variables
-    saver = loader = tf.train.Saver(tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES), max_to_keep=10)
+    # keep last 10 copies of all variables, including the optimizer slots, to resume training exactly
+    saver = loader = tf.train.Saver(tf.global_variables(), max_to_keep=10)
+    if FLAGS.async_checkpoint and FLAGS.train:
+        saver = AsyncSaver(tf.global_variables(), max_to_keep=10, checkpoint_dir=FLAGS.logdir + '/' + exp_string)
     
     # remove the need to explicitly pass this Session object to run ops
-    sess = tf.InteractiveSession()
+    sess = tf.InteractiveSession(config=session_config())
 
-    if FLAGS.train == False:
+    if FLAGS.train == False or FLAGS.num_replicas > 1:
         # change to original meta batch size when loading model.
         FLAGS.meta_batch_size = orig_meta_batch_size
 
-    if FLAGS.train_update_batch_size == -1:
-        FLAGS.train_update_batch_size = FLAGS.update_batch_size
-    if FLAGS.train_update_lr == -1:
-        FLAGS.train_update_lr = FLAGS.update_lr
-    
-    # cls = no of classes
-    # mbs = meta batch size
-    # ubs = update batch size
-    # numstep = number of INNER GRADIENT updates
-    # updatelr = inner gradient step
-    exp_string = 'cls_'+str(FLAGS.num_classes)+'.mbs_'+str(FLAGS.meta_batch_size) + '.ubs_' + str(FLAGS.train_update_batch_size) + '.numstep' + str(FLAGS.num_updates) + '.updatelr' + str(FLAGS.train_update_lr)
-
-    if FLAGS.num_filters != 64:
-        exp_string += 'hidden' + str(FLAGS.num_filters)
-    if FLAGS.max_pool:
-        exp_string += 'maxpool'
-    if FLAGS.stop_grad:
-        exp_string += 'stopgrad'
-    if FLAGS.baseline:
-        exp_string += FLAGS.baseline
-    if FLAGS.norm == 'batch_norm':
-        exp_string += 'batchnorm'
-    elif FLAGS.norm == 'layer_norm':
-        exp_string += 'layernorm'
-    elif FLAGS.norm == 'None':
-        exp_string += 'nonorm'
-    else:
-        print('Norm setting not recognized.')
-
     resume_itr = 0
     model_file = None
     
@@ -385,12 +518,31 @@ def main():
             ind1 = model_file.index('model')
             resume_itr = int(model_file[ind1+5:])
             print("Restoring model weights from " + model_file)
-            saver.restore(sess, model_file)
-
-    if FLAGS.train:
-        train(model, saver, sess, exp_string, data_generator, resume_itr)
+            restore_checkpoint(sess, loader, model_file, tf.global_variables())
+    if training_state:
+        # continue after the saved iteration, with the random generators where they were
+        resume_itr = training_state['itr'] + 1
+        random.setstate(training_state['python_random'])
+        np.random.set_state(training_state['numpy_random'])
+
+    replicas = None
+    if FLAGS.train and FLAGS.num_replicas > 1 and not FLAGS.validation_worker:
+        replicas = Replicas(FLAGS.num_replicas, FLAGS.replica_rank, FLAGS.coordinator_address)
+        # all replicas start from the (initialized or restored) weights of replica 0
+        replicas.sync_variables(sess, tf.global_variables()) # including the optimizer slots and beta powers
+        resume_itr = replicas.broadcast(resume_itr)
+
+    if FLAGS.validation_worker:
+        assert tf_data_load, 'the validation worker needs a meta-validation set'
+        run_validation_worker(model, sess, loader, data_generator, FLAGS.logdir + '/' + exp_string,
+                              FLAGS.pretrain_iterations + FLAGS.metatrain_iterations - 1)
+    elif FLAGS.train:
+        train(model, saver, sess, exp_string, data_generator, resume_itr, replicas)
+    elif FLAGS.embedding_cache:
+        test_embedding_cache(model, sess, exp_string, data_generator, model_file)
     else:
         test(model, saver, sess, exp_string, data_generator, test_num_updates)
+    data_generator.close()
 
 if __name__ == "__main__":
     main()
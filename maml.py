@@ -130,9 +130,9 @@ class MAML:
                 task_output = [task_outputa, task_outputbs, task_lossa, task_lossesb]
 
                 if self.classification:
-                    task_accuracya = tf.contrib.metrics.accuracy(tf.argmax(tf.nn.softmax(task_outputa), 1), tf.argmax(labela, 1))
+                    task_accuracya = tf.reduce_mean(tf.to_float(tf.equal(tf.argmax(task_outputa, 1), tf.argmax(labela, 1)))) # softmax keeps the argmax
                     for j in range(num_updates):
-                        task_accuraciesb.append(tf.contrib.metrics.accuracy(tf.argmax(tf.nn.softmax(task_outputbs[j]), 1), tf.argmax(labelb, 1)))
+                        task_accuraciesb.append(tf.reduce_mean(tf.to_float(tf.equal(tf.argmax(task_outputbs[j], 1), tf.argmax(labelb, 1)))))
                     task_output.extend([task_accuracya, task_accuraciesb])
 
                 return task_output
@@ -161,6 +161,10 @@ class MAML:
             if self.classification:
                 self.total_accuracy1 = total_accuracy1 = tf.reduce_sum(accuraciesa) / tf.to_float(FLAGS.meta_batch_size)
                 self.total_accuracies2 = total_accuracies2 = [tf.reduce_sum(accuraciesb[j]) / tf.to_float(FLAGS.meta_batch_size) for j in range(num_updates)]
+            # the same ops evaluate a meta-validation batch when the input is switched to it, see DataGenerator.make_switched_data_tensor
+            self.metaval_total_loss1, self.metaval_total_losses2 = total_loss1, total_losses2
+            if self.classification:
+                self.metaval_total_accuracy1, self.metaval_total_accuracies2 = total_accuracy1, total_accuracies2
             self.pretrain_op = tf.train.AdamOptimizer(self.meta_lr).minimize(total_loss1)
 
             if FLAGS.metatrain_iterations > 0: # FLAGS.metatrain_iterations = how many times to execute
@@ -183,6 +187,12 @@ class MAML:
                 self.metaval_total_accuracy1 = total_accuracy1 = tf.reduce_sum(accuraciesa) / tf.to_float(FLAGS.meta_batch_size)
                 self.metaval_total_accuracies2 = total_accuracies2 =[tf.reduce_sum(accuraciesb[j]) / tf.to_float(FLAGS.meta_batch_size) for j in range(num_updates)]
 
+            # per task results for test() in main.py: the accuracies, or the losses for regression
+            self.test_accuraciesa = accuraciesa if self.classification else lossesa
+            self.test_accuraciesb = [(accuraciesb if self.classification else lossesb)[j] for j in range(num_updates)]
+            self.labelas = self.labela
+            self.labelbs = self.labelb
+
         ## Summaries
         tf.summary.scalar(prefix+'Pre-update loss', total_loss1)
         if self.classification:
@@ -0,0 +1,257 @@
+"""
+Code for packing an image dataset split into one memory-mapped uint8 array.
+
+Every split folder (e.g. ./data/CIFARFS/train) holds one sub folder per class. Packing
+decodes all images of a split once and writes them to a single contiguous array
+<split>.npy of shape [num_images, height, width, channels], sorted by class, together
+with an index <split>.index.pkl holding the class names and class offsets into the array.
+Episodes are then assembled by indexing into the memory-mapped array, so no file has to
+be opened or decoded during training, and concurrent runs share one copy in the page cache.
+
+Omniglot is packed inverted (the pen strokes are bright), with the same gray levels the image files are
+fed with, and every character is stored four times, rotated by 0, 90, 180 and 270 degrees, as four
+separate classes, so episodes need neither decoding nor rotating. With --binarize, Omniglot is instead
+packed with one bit per pixel (set for the pen strokes) and takes a few MB. This thresholds the
+anti-aliased strokes, so it changes the inputs of the model: accuracies are not comparable with the
+ones of training on the image files.
+
+Usage Instructions:
+    python packed_data.py --datasource=cifarfs
+    python packed_data.py --datasource=miniimagenet
+    python packed_data.py --datasource=omniglot
+    python packed_data.py --datasource=omniglot --binarize
+
+    Then train or test with the '--packed_data=True' flag.
+"""
+from __future__ import print_function
+import argparse
+import multiprocessing
+import numpy as np
+import os
+import pickle
+import random
+
+DEFAULT_SPLIT_FOLDERS = {
+    'miniimagenet': ['./data/miniImagenet/train', './data/miniImagenet/val', './data/miniImagenet/test'],
+    'cifarfs': ['./data/CIFARFS/train', './data/CIFARFS/val', './data/CIFARFS/test'],
+    'omniglot': ['./data/omniglot_resized/train', './data/omniglot_resized/val', './data/omniglot_resized/test'],
+}
+DEFAULT_IMG_SIZES = {'miniimagenet': (84, 84), 'cifarfs': (32, 32), 'omniglot': (28, 28)}
+OMNIGLOT_ROTATIONS = 4 # multiples of 90 degrees
+
+def listdir_visible(folder):
+    """ List folder without the dot-prefixed names, e.g. the .tmp_ files of an interrupted preprocessing run """
+    return [name for name in os.listdir(folder) if not name.startswith('.')]
+
+def packed_paths(folder):
+    """ Return the paths of the image array and of the class index of a packed split
+
+    Args:
+        folder:     String with the path to the split folder, e.g. './data/CIFARFS/train'
+
+    returns:
+        tuple (image array path, index path)
+    """
+    folder = os.path.normpath(folder)
+    return folder + '.npy', folder + '.index.pkl'
+
+def omniglot_splits(data_folder, num_train=1100, num_val=100):
+    """ Split the omniglot characters into meta-train, meta-val and meta-test characters
+
+    As in MAML, all character folders are shuffled with seed 1: the first num_train characters are
+    meta-train characters, the next num_val meta-val characters and the rest meta-test characters.
+
+    Args:
+        data_folder:    String with the path to the omniglot folder, holding one sub folder per alphabet and per character
+        num_train:      Integer number of meta-train characters
+        num_val:        Integer number of meta-val characters
+
+    returns:
+        dictionary mapping 'train', 'val' and 'test' to lists of character folders
+    """
+    is_dir = lambda *path: os.path.isdir(os.path.join(data_folder, *path))
+    character_folders = [os.path.join(data_folder, family, character)
+                         for family in sorted(listdir_visible(data_folder)) if is_dir(family)
+                         for character in sorted(listdir_visible(os.path.join(data_folder, family))) if is_dir(family, character)]
+    random.Random(1).shuffle(character_folders)
+    return {'train': character_folders[:num_train],
+            'val': character_folders[num_train:num_train+num_val],
+            'test': character_folders[num_train+num_val:]}
+
+def write_packed_split(folder, class_names, class_sizes, fill_images, img_size, channels=3, bits=False):
+    """ Write a packed split, filling the image array class by class
+
+    The array and index are first written to temporary files which are renamed once
+    complete, so an interrupted pack never leaves a half-written store behind.
+
+    Args:
+        folder:         String with the path to the split folder the store belongs to
+        class_names:    List of strings with the class names, in storage order
+        class_sizes:    List of integers with the number of images of each class
+        fill_images:    Function fill_images(class_idx, out) that writes the images of class class_idx into the uint8 array out
+        img_size:       Tuple (height, width) of the images
+        channels:       Integer equal to the number of image channels
+        bits:           A boolean, store binary images with one bit per pixel: fill_images then writes np.packbits rows
+
+    returns:
+        tuple (image array path, index path)
+    """
+    images_path, index_path = packed_paths(folder)
+    offsets = np.concatenate([[0], np.cumsum(class_sizes)]).astype(np.int64)
+    if bits:
+        image_shape = ((img_size[0] * img_size[1] * channels + 7) // 8,)
+    else:
+        image_shape = (img_size[0], img_size[1], channels)
+
+    images = np.lib.format.open_memmap(images_path + '.tmp', mode='w+', dtype=np.uint8,
+                                       shape=(int(offsets[-1]),) + image_shape)
+    for c in range(len(class_names)):
+        fill_images(c, images[offsets[c]:offsets[c+1]])
+    images.flush()
+    del images
+
+    with open(index_path + '.tmp', 'wb') as f:
+        pickle.dump({'class_names': list(class_names), 'offsets': offsets,
+                     'img_size': tuple(img_size), 'channels': channels, 'bits': bits}, f)
+    os.rename(images_path + '.tmp', images_path)
+    os.rename(index_path + '.tmp', index_path)
+    return images_path, index_path
+
+def decode_image(args):
+    """ Decode the image file at path into a uint8 array of shape img_size + (channels,) """
+    path, img_size, channels = args
+    from PIL import Image
+    im = Image.open(path).convert('RGB' if channels == 3 else 'L')
+    if im.size != (img_size[1], img_size[0]):
+        raise ValueError('Image %s has size %s, expected %s' % (path, im.size, img_size))
+    return np.asarray(im, dtype=np.uint8).reshape(img_size[0], img_size[1], channels)
+
+def pack_split(folder, img_size, channels=3, pool=None):
+    """ Decode all images of a split folder once, and write them as a packed split
+
+    Args:
+        folder:     String with the path to the split folder, one sub folder per class
+        img_size:   Tuple (height, width) the images are expected to have
+        channels:   Integer equal to the number of image channels (3 for RGB, 1 for grayscale)
+        pool:       multiprocessing.Pool decoding the images in parallel, or None to decode them in this process
+
+    returns:
+        tuple (image array path, index path)
+    """
+    class_names = sorted(label for label in listdir_visible(folder) if os.path.isdir(os.path.join(folder, label)))
+    class_files = [sorted(listdir_visible(os.path.join(folder, label))) for label in class_names]
+    map_func = pool.map if pool is not None else map
+
+    def fill_images(c, out):
+        paths = [os.path.join(folder, class_names[c], filename) for filename in class_files[c]]
+        for i, image in enumerate(map_func(decode_image, [(path, img_size, channels) for path in paths])):
+            out[i] = image
+        print('Packed class ' + class_names[c])
+
+    return write_packed_split(folder, class_names, [len(files) for files in class_files], fill_images, img_size, channels)
+
+def pack_omniglot_split(folder, character_folders, img_size=(28, 28), pool=None, binarize=False):
+    """ Decode all images of the omniglot characters once, and write them inverted, every rotation as a class
+
+    Class 4*i+r holds the images of character i rotated by r*90 degrees.
+
+    Args:
+        folder:             String with the path of the split, e.g. './data/omniglot_resized/train'
+        character_folders:  List of strings with the character folders of the split, see omniglot_splits
+        img_size:           Tuple (height, width) the images are expected to have
+        pool:               multiprocessing.Pool decoding the images in parallel, or None to decode them in this process
+        binarize:           A boolean, threshold the strokes and write them bit-packed instead of as gray levels (see the module docstring)
+
+    returns:
+        tuple (image array path, index path)
+    """
+    class_files = [sorted(listdir_visible(character_folder)) for character_folder in character_folders]
+    class_names = ['%s/rot%d' % ('/'.join(character_folder.split(os.sep)[-2:]), 90*r)
+                   for character_folder in character_folders for r in range(OMNIGLOT_ROTATIONS)]
+    map_func = pool.map if pool is not None else map
+    decoded = {} # the strokes of the last decoded character, shared by its rotations
+
+    def fill_images(c, out):
+        character, rotation = divmod(c, OMNIGLOT_ROTATIONS)
+        if character not in decoded:
+            paths = [os.path.join(character_folders[character], filename) for filename in class_files[character]]
+            images = np.stack(list(map_func(decode_image, [(path, img_size, 1) for path in paths])))
+            decoded.clear()
+            # dark strokes on a white background, inverted as by DataGenerator.decode_image
+            decoded[character] = images[..., 0] < 128 if binarize else 255 - images
+        strokes = np.rot90(decoded[character], rotation, axes=(1, 2))
+        if binarize:
+            out[:] = np.packbits(strokes.reshape(len(strokes), -1), axis=1)
+        else:
+            out[:] = strokes
+        if rotation == OMNIGLOT_ROTATIONS - 1:
+            print('Packed character ' + class_names[c][:-len('/rot270')])
+
+    return write_packed_split(folder, class_names, [len(files) for files in class_files for r in range(OMNIGLOT_ROTATIONS)],
+                              fill_images, img_size, channels=1, bits=binarize)
+
+class PackedImageStore(object):
+    """ Read-only, memory-mapped view on a packed split
+
+    Attributes:
+        class_names:    List of strings with the class names
+        offsets:        Array of integers, images of class c are images[offsets[c]:offsets[c+1]]
+        images:         Memory-mapped uint8 array of shape [num_images, height, width, channels], or [num_images, bytes] if bit-packed
+        image_shape:    Tuple (height, width, channels) of the images returned by gather
+    """
+    def __init__(self, folder):
+        """
+        Args:
+            folder:     String with the path to the split folder the store was packed from
+        """
+        images_path, index_path = packed_paths(folder)
+        with open(index_path, 'rb') as f:
+            index = pickle.load(f)
+        self.class_names = index['class_names']
+        self.offsets = index['offsets']
+        self.image_shape = tuple(index['img_size']) + (index['channels'],)
+        self.bits = index.get('bits', False)
+        self.images = np.load(images_path, mmap_mode='r')
+
+    @property
+    def num_classes(self):
+        return len(self.class_names)
+
+    @property
+    def class_sizes(self):
+        return np.diff(self.offsets)
+
+    def gather(self, indices):
+        """ Copy the images at the given (global) indices out of the memory-mapped array, as uint8 arrays of image_shape """
+        indices = np.asarray(indices)
+        images = self.images[indices]
+        if self.bits:
+            # one vectorized unpack for all images, set bits become 255 like the pixels of the other stores
+            images = np.unpackbits(images, axis=-1)[..., :int(np.prod(self.image_shape))] * np.uint8(255)
+            images = images.reshape(indices.shape + self.image_shape)
+        return images
+
+def main():
+    parser = argparse.ArgumentParser(description='Pack the train/val/test splits of a dataset into memory-mapped arrays.')
+    parser.add_argument('--datasource', default='cifarfs', choices=sorted(DEFAULT_SPLIT_FOLDERS.keys()))
+    parser.add_argument('--folders', nargs='*', default=None, help='split folders to pack (default: train, val and test of the datasource)')
+    parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count(), help='number of processes decoding the images')
+    parser.add_argument('--binarize', action='store_true', help='omniglot only: store the strokes with one bit per pixel, which changes the inputs of the model')
+    args = parser.parse_args()
+
+    pool = multiprocessing.Pool(args.processes)
+    for folder in args.folders or DEFAULT_SPLIT_FOLDERS[args.datasource]:
+        print('Packing ' + folder)
+        if args.datasource == 'omniglot':
+            # the splits are subsets of the characters, folder names the split (train, val or test) next to the characters
+            character_folders = omniglot_splits(os.path.dirname(os.path.normpath(folder)))[os.path.basename(os.path.normpath(folder))]
+            images_path, index_path = pack_omniglot_split(folder, character_folders, DEFAULT_IMG_SIZES[args.datasource], pool=pool,
+                                                          binarize=args.binarize)
+        else:
+            images_path, index_path = pack_split(folder, DEFAULT_IMG_SIZES[args.datasource], pool=pool)
+        print('Wrote ' + images_path + ' and ' + index_path)
+    pool.close()
+    pool.join()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+Code for profiling the training loop.
+
+Every training step records its wall time. Every trace_interval steps the step is run with a full
+trace: the trace is written as a Chrome trace (open chrome://tracing and load the file) and the op
+times of the step are split into the stages of an iteration by name scope:
+    input:      ops of the input pipeline (built under the 'input' name scope in main)
+    ridge:      the closed-form ridge regression ('ridge_solve' name scope, see utils.ridge_regression)
+    backward:   the meta-gradients and optimizer ('gradients' name scope of tf.gradients, 'Adam')
+    forward:    all other ops
+Op times are summed over all threads, so with parallel ops the stages add up to more than the step.
+
+Every report, steps/sec, tasks/sec, images/sec, the p50/p95/p99 step latency, the time spent writing
+summaries and the stage times of the last trace are written to the summary writer and appended as
+one JSON line to profile.jsonl in the experiment folder.
+"""
+from __future__ import print_function
+import json
+import numpy as np
+import os
+import tensorflow as tf
+
+from tensorflow.python.client import timeline
+
+STAGES = ['input', 'forward', 'ridge', 'backward']
+
+def op_stage(node_name):
+    """ Return the stage (see STAGES) the op with the given name belongs to """
+    scopes = node_name.split('/')
+    if scopes[0].startswith('input'):
+        return 'input'
+    if 'gradients' in scopes or scopes[0].startswith('Adam'):
+        return 'backward'
+    if 'ridge_solve' in scopes:
+        return 'ridge'
+    return 'forward'
+
+class StepProfiler(object):
+    """ Collects the timings of the training steps between two reports """
+    def __init__(self, logdir, trace_interval, tasks_per_step, images_per_step):
+        """
+        Args:
+            logdir:             String with the experiment folder, the traces and profile.jsonl are written there
+            trace_interval:     Integer, a full trace is captured every trace_interval steps (never if 0)
+            tasks_per_step:     Integer number of tasks in one meta-batch
+            images_per_step:    Integer number of images in one meta-batch
+        """
+        self.logdir = logdir
+        self.trace_interval = trace_interval
+        self.tasks_per_step = tasks_per_step
+        self.images_per_step = images_per_step
+        self.step_times, self.summary_time = [], 0.
+        self.stage_times = {}
+        if not os.path.exists(logdir):
+            os.makedirs(logdir)
+
+    def run_args(self, itr):
+        """ Return the keyword arguments of sess.run for step itr, requesting a full trace every trace_interval steps """
+        if self.trace_interval > 0 and itr % self.trace_interval == 0:
+            return {'options': tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE), 'run_metadata': tf.RunMetadata()}
+        return {}
+
+    def record_step(self, itr, step_time, run_args, summary_writer=None):
+        """ Record the wall time of step itr, and write the trace of the step if one was requested
+
+        Args:
+            itr:                Integer training iteration
+            step_time:          Float with the wall time of the step in seconds
+            run_args:           Dictionary returned by run_args for this step, after the step ran
+            summary_writer:     tf.summary.FileWriter to add the run metadata to, or None
+        """
+        self.step_times.append(step_time)
+        if 'run_metadata' not in run_args:
+            return
+        step_stats = run_args['run_metadata'].step_stats
+        with open(os.path.join(self.logdir, 'timeline_%d.json' % itr), 'w') as f:
+            f.write(timeline.Timeline(step_stats).generate_chrome_trace_format())
+        if summary_writer is not None:
+            summary_writer.add_run_metadata(run_args['run_metadata'], 'step%d' % itr, itr)
+
+        self.stage_times = dict((stage, 0.) for stage in STAGES)
+        for device_stats in step_stats.dev_stats:
+            for node_stats in device_stats.node_stats:
+                self.stage_times[op_stage(node_stats.node_name)] += node_stats.all_end_rel_micros / 1000.
+
+    def record_summary(self, summary_time):
+        """ Record the wall time (seconds) spent writing summaries """
+        self.summary_time += summary_time
+
+    def report(self, itr, summary_writer=None):
+        """ Print the statistics of the steps since the last report, write them to the summary writer and profile.jsonl """
+        if not self.step_times:
+            return
+        step_times = np.array(self.step_times)
+        steps_per_sec = len(step_times) / np.sum(step_times)
+        stats = {'itr': itr,
+                 'steps_per_sec': steps_per_sec,
+                 'tasks_per_sec': steps_per_sec * self.tasks_per_step,
+                 'images_per_sec': steps_per_sec * self.images_per_step,
+                 'summary_ms': 1000 * self.summary_time}
+        for p in [50, 95, 99]:
+            stats['p%d_ms' % p] = 1000 * np.percentile(step_times, p)
+        for stage, stage_time in self.stage_times.items():
+            stats[stage + '_ms'] = stage_time
+
+        print('%.2f steps/sec, %.1f tasks/sec, %.0f images/sec, step p50/p95/p99 %.1f/%.1f/%.1f ms' %
+              (stats['steps_per_sec'], stats['tasks_per_sec'], stats['images_per_sec'], stats['p50_ms'], stats['p95_ms'], stats['p99_ms']))
+        if self.stage_times:
+            print('Last trace: ' + ', '.join('%s %.1f ms' % (stage, self.stage_times[stage]) for stage in STAGES))
+        if summary_writer is not None:
+            summary_writer.add_summary(tf.Summary(value=[tf.Summary.Value(tag='profile/' + key, simple_value=value)
+                                                         for key, value in sorted(stats.items()) if key != 'itr']), itr)
+        with open(os.path.join(self.logdir, 'profile.jsonl'), 'a') as f:
+            f.write(json.dumps(dict((key, value if key == 'itr' else float(value)) for key, value in stats.items()), sort_keys=True) + '\n')
+
+        self.step_times, self.summary_time = [], 0.
+        self.stage_times = {}
@@ -10,7 +10,7 @@ except KeyError as e:
           file=sys.stderr)
 
 from tensorflow.python.platform import flags
-from utils import mse, xent, conv_block, normalize
+from utils import mse, xent, conv_block, normalize, ridge_regression, select_ridge_form, static_shape
 
 FLAGS = flags.FLAGS
 
@@ -79,6 +79,9 @@ class R2D2:
                 # this is done when construct_model is called
                 self.weights = weights = self.construct_weights()
 
+            # solve the base learner in the cheaper of the primal and dual forms, for this support set size
+            self.ridge_form = select_ridge_form(self.dim_output*FLAGS.update_batch_size, int(weights['stop_w5'].get_shape()[0]))
+
             # outputbs[i] and lossesb[i] is the output and loss after i+1 gradient updates
             lossesa, outputas, lossesb, outputbs, labelas, labelbs = [], [], [], [], [], []
             accuraciesa, accuraciesb = [], []
@@ -95,20 +98,15 @@ class R2D2:
                 if self.classification:
                     task_accuraciesb = []
                 
-                task_outputa = self.forward(inputa, weights, reuse=reuse)  # only reuse on the first iter
+                ## Pass through CNN once, the support features give both the pre-update logits and the ridge solve
+                x = self.forward_conv_CNN(inputa, weights, reuse=reuse)  # only reuse on the first iter
+                task_outputa = self.forward_conv_lr(x, weights, reuse=reuse)
                 task_lossa = self.loss_func(task_outputa, labela)
                 
-                ## Pass through CNN
-                x = self.forward_conv_CNN(inputa, weights, reuse=True)                
-                
                 ## Linear Regression with Woodbury Identity
-                # using training set (a) to determine new weights for linear regressor
-                xT = tf.transpose(x)
-                xxT = tf.matmul(x,xT)
-                
-                # Calculate new LINEAR REGRESSION weights on train set, using the Woodbury identity
+                # Calculate new LINEAR REGRESSION weights on train set (a), in primal or dual (Woodbury) form
                 fast_weights = dict(zip(weights.keys(), [weights[key] for key in weights.keys()]))
-                fast_weights['stop_w5'] = tf.stop_gradient(tf.matmul(tf.matmul(xT,tf.linalg.inv(xxT + weights['lr_lambda'] * tf.eye(tf.shape(xxT)[0],tf.shape(xxT)[1]))),labela))
+                fast_weights['stop_w5'] = tf.stop_gradient(ridge_regression(x, labela, weights['lr_lambda'], form=self.ridge_form))
                 
                 # MAML line 8: calculate output/loss on test set (b), internally does LR conversion with scale alpha and bias beta
                 output = self.forward(inputb, fast_weights, reuse=True)
@@ -137,23 +135,27 @@ class R2D2:
                 task_output = [task_outputa, task_outputbs, task_lossa, task_lossesb]
 
                 if self.classification:
-                    task_accuracya = tf.contrib.metrics.accuracy(tf.argmax(tf.nn.softmax(task_outputa), 1), tf.argmax(labela, 1))
+                    task_accuracya = tf.reduce_mean(tf.to_float(tf.equal(tf.argmax(task_outputa, 1), tf.argmax(labela, 1)))) # softmax keeps the argmax
                     for j in range(num_updates):
-                        task_accuraciesb.append(tf.contrib.metrics.accuracy(tf.argmax(tf.nn.softmax(task_outputbs[j]), 1), tf.argmax(labelb, 1)))
+                        task_accuraciesb.append(tf.reduce_mean(tf.to_float(tf.equal(tf.argmax(task_outputbs[j], 1), tf.argmax(labelb, 1)))))
                     task_output.extend([task_accuracya, task_accuraciesb])
 
                 return task_output
 
-            if FLAGS.norm is not 'None': # to initialize batch norm variables
-                # to initialize the batch norm vars, might want to combine this, and not run idx 0 twice.
-                unused = task_metalearn((self.inputa[0], self.inputb[0], self.labela[0], self.labelb[0]), False)
+            if FLAGS.batched_tasks:
+                # all tasks of the meta-batch at once: one CNN pass and one batched ridge solve
+                result = self.batched_metalearn(weights, num_updates)
+            else:
+                if FLAGS.norm is not 'None': # to initialize batch norm variables
+                    # only the CNN creates batch norm variables, so build just the conv tower on task 0 (never run)
+                    unused = self.forward_conv_CNN(self.inputa[0], weights, reuse=False)
 
-            out_dtype = [tf.float32, [tf.float32]*num_updates, tf.float32, [tf.float32]*num_updates]
-            if self.classification: # accuracies are also stored
-                out_dtype.extend([tf.float32, [tf.float32]*num_updates])
-            # THE REAL LEARNING CONSTRUCTION OCCURS HERE
-            # IMPORTANT: executes in parallel for ALL TASKS in batch I guess? The inputs are formatted in a special way to contain multiple tasks?
-            result = tf.map_fn(task_metalearn, elems=(self.inputa, self.inputb, self.labela, self.labelb), dtype=out_dtype, parallel_iterations=FLAGS.meta_batch_size)
+                out_dtype = [tf.float32, [tf.float32]*num_updates, tf.float32, [tf.float32]*num_updates]
+                if self.classification: # accuracies are also stored
+                    out_dtype.extend([tf.float32, [tf.float32]*num_updates])
+                # THE REAL LEARNING CONSTRUCTION OCCURS HERE
+                # IMPORTANT: executes in parallel for ALL TASKS in batch I guess? The inputs are formatted in a special way to contain multiple tasks?
+                result = tf.map_fn(task_metalearn, elems=(self.inputa, self.inputb, self.labela, self.labelb), dtype=out_dtype, parallel_iterations=FLAGS.meta_batch_size)
             if self.classification:
                 outputas, outputbs, lossesa, lossesb, accuraciesa, accuraciesb = result
             else:
@@ -169,6 +171,10 @@ class R2D2:
             if self.classification:
                 self.total_accuracy1 = total_accuracy1 = tf.reduce_sum(accuraciesa) / tf.to_float(FLAGS.meta_batch_size)
                 self.total_accuracies2 = total_accuracies2 = [tf.reduce_sum(accuraciesb[j]) / tf.to_float(FLAGS.meta_batch_size) for j in range(num_updates)]
+            # the same ops evaluate a meta-validation batch when the input is switched to it, see DataGenerator.make_switched_data_tensor
+            self.metaval_total_loss1, self.metaval_total_losses2 = total_loss1, total_losses2
+            if self.classification:
+                self.metaval_total_accuracy1, self.metaval_total_accuracies2 = total_accuracy1, total_accuracies2
             self.pretrain_op = tf.train.AdamOptimizer(self.meta_lr).minimize(total_loss1)
 
             if FLAGS.metatrain_iterations > 0: # FLAGS.metatrain_iterations = how many times to execute
@@ -177,6 +183,13 @@ class R2D2:
                 
                 # Compute gradients after num_updates
                 self.gvs = gvs = optimizer.compute_gradients(self.total_losses2[FLAGS.num_updates-1])
+
+                if FLAGS.num_replicas > 1:
+                    # data-parallel: the gradients of this replica's tasks are averaged over all replicas and fed back (see replicas.py)
+                    gvs = [(grad, var) for grad, var in gvs if grad is not None]
+                    self.replica_grads = [grad for grad, var in gvs]
+                    self.replica_grad_placeholders = [tf.placeholder(grad.dtype, grad.get_shape()) for grad in self.replica_grads]
+                    gvs = list(zip(self.replica_grad_placeholders, [var for grad, var in gvs]))
                 
                 #grads = tf.gradients(loss, list(fast_weights.values()))
                 #grads = [tf.stop_gradient(grad) for grad in gvs]
@@ -214,6 +227,39 @@ class R2D2:
             if self.classification:
                 tf.summary.scalar(prefix+'Post-update accuracy, step ' + str(j+1), total_accuracies2[j])
 
+    def batched_metalearn(self, weights, num_updates):
+        """ Base learning for all tasks in the meta-batch at once
+
+        The support (a) and query (b) images of all tasks go through the CNN in a single call,
+        and the ridge regression problems of all tasks are solved with batched matrix products.
+        Note that batch normalization then uses statistics over the whole meta-batch.
+
+        returns:
+            list with the same structure as the result of tf.map_fn over task_metalearn
+        """
+        shape_a, shape_b = static_shape(self.inputa), static_shape(self.inputb)
+        num_a = shape_a[0]*shape_a[1]
+        images = tf.concat([tf.reshape(self.inputa, [-1, self.dim_input]), tf.reshape(self.inputb, [-1, self.dim_input])], 0)
+        features = self.forward_conv_CNN(images, weights, reuse=False) # reuse is inherited when the weights already exist
+        flat_dim = int(features.get_shape()[1])
+        xa = tf.reshape(features[:num_a], [shape_a[0], shape_a[1], flat_dim])
+        xb = tf.reshape(features[num_a:], [shape_b[0], shape_b[1], flat_dim])
+
+        # pre-update output, with the meta-learned regression weights
+        outputas = weights['lr_alpha']*tf.tensordot(xa, tf.stop_gradient(weights['stop_w5']), 1) + weights['lr_beta']
+
+        # Linear Regression (ridge), one problem per task
+        task_w5 = tf.stop_gradient(ridge_regression(xa, self.labela, weights['lr_lambda'], form=self.ridge_form))
+        outputbs = weights['lr_alpha']*tf.matmul(xb, task_w5) + weights['lr_beta']
+
+        # NO (further) INNER STEPS REQUIRED FOR LINEAR REGRESSION, all updates give the same output
+        lossesa, lossesb = self.loss_func(outputas, self.labela), self.loss_func(outputbs, self.labelb)
+        result = [outputas, [outputbs]*num_updates, lossesa, [lossesb]*num_updates]
+        if self.classification:
+            task_accuracy = lambda output, label: tf.reduce_mean(tf.to_float(tf.equal(tf.argmax(output, 2), tf.argmax(label, 2))), 1)
+            result.extend([task_accuracy(outputas, self.labela), [task_accuracy(outputbs, self.labelb)]*num_updates])
+        return result
+
     ### Network construction functions
     ## CNN
     # initialize and return weights for CNN
@@ -240,6 +286,8 @@ class R2D2:
         flat_dim = 640
         if FLAGS.datasource == 'miniimagenet': # 84x84 * (1/2 + 1/2/2/2)
             flat_dim = 4000
+        elif FLAGS.datasource == 'omniglot': # 28x28 -> 3x3 after layer 3 and 1x1 after layer 4
+            flat_dim = self.dim_hidden * (3*3 + 1*1)
         else:# cifarfs 32x32 * (1/2 + 1/2/2/2) = 640
             flat_dim = 640 
         
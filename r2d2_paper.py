@@ -10,7 +10,7 @@ except KeyError as e:
           file=sys.stderr)
 
 from tensorflow.python.platform import flags
-from utils import mse, xent, conv_block, normalize
+from utils import mse, xent, conv_block, normalize, ridge_regression, select_ridge_form, static_shape
 
 FLAGS = flags.FLAGS
 
@@ -144,6 +144,9 @@ class R2D2_paper:
                 # this is done when construct_model is called
                 self.weights = weights = self.construct_weights()
 
+            # solve the base learner in the cheaper of the primal and dual forms, for this support set size
+            self.ridge_form = select_ridge_form(self.dim_output*FLAGS.update_batch_size, int(weights['stop_w5'].get_shape()[0]))
+
             # outputbs[i] and lossesb[i] is the output and loss after i+1 gradient updates
             lossesa, outputas, lossesb, outputbs, labelas, labelbs = [], [], [], [], [], []
             accuraciesa, accuraciesb = [], []
@@ -160,17 +163,14 @@ class R2D2_paper:
                 if self.classification:
                     task_accuraciesb = []
                 
-                task_outputa = self.forward(inputa, weights, reuse=reuse)  # only reuse on the first iter
+                ## Pass through CNN once, the support features give both the pre-update logits and the ridge solve
+                x = self.forward_conv_CNN(inputa, weights, reuse=reuse)  # only reuse on the first iter
+                task_outputa = self.forward_conv_lr(x, weights, reuse=reuse)
                 task_lossa = self.loss_func(task_outputa, labela)
                 
-                ## Pass through CNN
-                x = self.forward_conv_CNN(inputa, weights, reuse=True)                
-                
-                # Linear Regression with Woodbury Identity using training set (a) to determine new weights for linear regressor
-                xT = tf.transpose(x)
-                xxT = tf.matmul(x,xT)
+                # Linear Regression, in primal or dual (Woodbury) form, using training set (a) to determine new weights for linear regressor
                 fast_weights = dict(zip(weights.keys(), [weights[key] for key in weights.keys()])) # Copy current weights
-                fast_weights['stop_w5'] = tf.matmul(tf.matmul(xT,tf.linalg.inv(xxT + weights['lr_lambda'] * tf.eye(tf.shape(xxT)[0],tf.shape(xxT)[1]))),labela)
+                fast_weights['stop_w5'] = ridge_regression(x, labela, weights['lr_lambda'], form=self.ridge_form)
 
                 # for dropout
                 if FLAGS.train:
@@ -187,22 +187,26 @@ class R2D2_paper:
                 
                 # When classification, extend the output with accuracies
                 if self.classification:
-                    task_accuracya = tf.contrib.metrics.accuracy(tf.argmax(tf.nn.softmax(task_outputa), 1), tf.argmax(labela, 1))
+                    task_accuracya = tf.reduce_mean(tf.to_float(tf.equal(tf.argmax(task_outputa, 1), tf.argmax(labela, 1)))) # softmax keeps the argmax
                     for j in range(num_updates):
-                        task_accuraciesb.append(tf.contrib.metrics.accuracy(tf.argmax(tf.nn.softmax(task_outputbs[j]), 1), tf.argmax(labelb, 1)))
+                        task_accuraciesb.append(tf.reduce_mean(tf.to_float(tf.equal(tf.argmax(task_outputbs[j], 1), tf.argmax(labelb, 1)))))
                     task_output.extend([task_accuracya, task_accuraciesb])
 
                 return task_output
 
-            if FLAGS.norm is not 'None': # to initialize BatchNorm variables, run the base_learning step on task 0
-                unused = task_baselearn((self.inputa[0], self.inputb[0], self.labela[0], self.labelb[0]), False)
+            if FLAGS.batched_tasks:
+                # Executes fine tuning for ALL TASKS in meta batch at once: one CNN pass and one batched ridge solve
+                result = self.batched_baselearn(weights, num_updates)
+            else:
+                if FLAGS.norm is not 'None': # to initialize BatchNorm variables, build the CNN on task 0 (only the CNN has BatchNorm, never run)
+                    unused = self.forward_conv_CNN(self.inputa[0], weights, reuse=False)
 
-            out_dtype = [tf.float32, [tf.float32]*num_updates, tf.float32, [tf.float32]*num_updates]
-            if self.classification: # accuracies are also stored in the case of classification
-                out_dtype.extend([tf.float32, [tf.float32]*num_updates])
+                out_dtype = [tf.float32, [tf.float32]*num_updates, tf.float32, [tf.float32]*num_updates]
+                if self.classification: # accuracies are also stored in the case of classification
+                    out_dtype.extend([tf.float32, [tf.float32]*num_updates])
 
-            # Executes fine tuning for ALL TASKS in meta batch: the input queues are formatted in a way to contain multiple tasks
-            result = tf.map_fn(task_baselearn, elems=(self.inputa, self.inputb, self.labela, self.labelb), dtype=out_dtype, parallel_iterations=FLAGS.meta_batch_size)
+                # Executes fine tuning for ALL TASKS in meta batch: the input queues are formatted in a way to contain multiple tasks
+                result = tf.map_fn(task_baselearn, elems=(self.inputa, self.inputb, self.labela, self.labelb), dtype=out_dtype, parallel_iterations=FLAGS.meta_batch_size)
             if self.classification:
                 outputas, outputbs, lossesa, lossesb, accuraciesa, accuraciesb = result
             else:
@@ -218,6 +222,10 @@ class R2D2_paper:
             if self.classification:
                 self.total_accuracy1 = total_accuracy1 = tf.reduce_sum(accuraciesa) / tf.to_float(FLAGS.meta_batch_size)
                 self.total_accuracies2 = total_accuracies2 = [tf.reduce_sum(accuraciesb[j]) / tf.to_float(FLAGS.meta_batch_size) for j in range(num_updates)]
+            # the same ops evaluate a meta-validation batch when the input is switched to it, see DataGenerator.make_switched_data_tensor
+            self.metaval_total_loss1, self.metaval_total_losses2 = total_loss1, total_losses2
+            if self.classification:
+                self.metaval_total_accuracy1, self.metaval_total_accuracies2 = total_accuracy1, total_accuracies2
             self.pretrain_op = tf.train.AdamOptimizer(self.meta_lr).minimize(total_loss1)
 
             if FLAGS.metatrain_iterations > 0: # FLAGS.metatrain_iterations = how many times to execute
@@ -226,6 +234,13 @@ class R2D2_paper:
                 
                 # Compute gradients after num_updates
                 self.gvs = gvs = optimizer.compute_gradients(self.total_losses2[FLAGS.num_updates-1])
+
+                if FLAGS.num_replicas > 1:
+                    # data-parallel: the gradients of this replica's tasks are averaged over all replicas and fed back (see replicas.py)
+                    gvs = [(grad, var) for grad, var in gvs if grad is not None]
+                    self.replica_grads = [grad for grad, var in gvs]
+                    self.replica_grad_placeholders = [tf.placeholder(grad.dtype, grad.get_shape()) for grad in self.replica_grads]
+                    gvs = list(zip(self.replica_grad_placeholders, [var for grad, var in gvs]))
                 
                 # Gradients are clipped by [-10,10] to avoid gradient explosion
                 if FLAGS.datasource == 'miniimagenet' or FLAGS.datasource == 'cifarfs':
@@ -262,6 +277,45 @@ class R2D2_paper:
             if self.classification:
                 tf.summary.scalar(prefix+'Post-update accuracy, step ' + str(j+1), total_accuracies2[j])
 
+    def batched_baselearn(self, weights, num_updates):
+        """Finetunes on all tasks in the meta-batch at once
+
+        The support (a) and query (b) images of all tasks go through the CNN in a single call,
+        with dropout only on the query images as in task_baselearn, and the ridge regression
+        problems of all tasks are solved with batched matrix products. Note that batch
+        normalization then uses statistics over the whole meta-batch.
+
+        Args:
+            weights:        Model weights to be used
+            num_updates:    An integer equal to the amount of updates to report outputs, losses and accuracies for
+
+        Returns:
+            A list with the same structure as the result of tf.map_fn over task_baselearn
+        """
+        shape_a, shape_b = static_shape(self.inputa), static_shape(self.inputb)
+        num_a = shape_a[0]*shape_a[1]
+        images = tf.concat([tf.reshape(self.inputa, [-1, self.dim_input]), tf.reshape(self.inputb, [-1, self.dim_input])], 0)
+        is_query = tf.range(static_shape(images)[0]) >= num_a
+        features = self.forward_conv_CNN(images, weights, reuse=False, is_training=is_query) # reuse is inherited when the weights already exist
+        flat_dim = int(features.get_shape()[1])
+        xa = tf.reshape(features[:num_a], [shape_a[0], shape_a[1], flat_dim])
+        xb = tf.reshape(features[num_a:], [shape_b[0], shape_b[1], flat_dim])
+
+        # pre-update output, with the meta-learned regression weights
+        outputas = weights['lr_alpha']*tf.tensordot(xa, weights['stop_w5'], 1) + weights['lr_beta']
+
+        # Linear Regression (ridge), one problem per task
+        task_w5 = ridge_regression(xa, self.labela, weights['lr_lambda'], form=self.ridge_form)
+        outputbs = weights['lr_alpha']*tf.matmul(xb, task_w5) + weights['lr_beta']
+
+        # The base learner is solved in closed form, so all updates give the same output
+        lossesa, lossesb = self.loss_func(outputas, self.labela), self.loss_func(outputbs, self.labelb)
+        result = [outputas, [outputbs]*num_updates, lossesa, [lossesb]*num_updates]
+        if self.classification:
+            task_accuracy = lambda output, label: tf.reduce_mean(tf.to_float(tf.equal(tf.argmax(output, 2), tf.argmax(label, 2))), 1)
+            result.extend([task_accuracy(outputas, self.labela), [task_accuracy(outputbs, self.labelb)]*num_updates])
+        return result
+
     def construct_conv_weights(self):
         """ R2D2 model weights initialziation:
         4 conv blocks:
@@ -297,11 +351,15 @@ class R2D2_paper:
                 flat_dim = 4000
             elif FLAGS.datasource == 'cifarfs':
                 flat_dim = 640
+            elif FLAGS.datasource == 'omniglot': # 28x28 -> 3x3 after layer 3 and 1x1 after layer 4
+                flat_dim = 320
         else:
             if FLAGS.datasource == 'miniimagenet':
                 flat_dim = 51200
             elif FLAGS.datasource == 'cifarfs':
                 flat_dim = 8192
+            elif FLAGS.datasource == 'omniglot': # 3*3*384 + 1*1*512
+                flat_dim = 3968
         
         weights['stop_w5'] = tf.get_variable('stop_w5', [flat_dim, self.dim_output], initializer=fc_initializer)
         
@@ -326,7 +384,7 @@ class R2D2_paper:
             weights:        Model weights to be used for forward prediction
             reuse:          A boolean which defines whether or not to reuse the batch normalization initialization
             scope:          TensorFlow Variable scope to be used
-            is_training:    A boolean signifying whether we are training or not, relevant for dropout
+            is_training:    A boolean signifying whether we are training or not, relevant for dropout (see dropout_layer)
             
         """
         out = self.forward_conv_CNN(inp, weights, reuse=reuse, scope=scope, is_training=is_training)
@@ -355,9 +413,9 @@ class R2D2_paper:
         hidden1 = conv_block(inp, weights['conv1'], weights['b1'], reuse, scope+'0', activation = self.activation)
         hidden2 = conv_block(hidden1, weights['conv2'], weights['b2'], reuse, scope+'1', activation = self.activation)
         hidden3 = conv_block(hidden2, weights['conv3'], weights['b3'], reuse, scope+'2', activation = self.activation)
-        hidden3 = tf.layers.dropout(hidden3, rate=self.dropout, training=is_training)
+        hidden3 = self.dropout_layer(hidden3, is_training)
         hidden4 = conv_block(hidden3, weights['conv4'], weights['b4'], reuse, scope+'3', activation = self.activation)
-        hidden4 = tf.layers.dropout(hidden4, rate=self.dropout, training=is_training)
+        hidden4 = self.dropout_layer(hidden4, is_training)
         
         # Flattening of blocks 3 and 4
         hidden3 = tf.reshape(hidden3, [-1, np.prod([int(dim) for dim in hidden3.get_shape()[1:]])])
@@ -368,6 +426,17 @@ class R2D2_paper:
         
         return flatconcat34
         
+    def dropout_layer(self, inp, is_training):
+        """ Dropout with rate self.dropout
+
+        Args:
+            inp:            Tensor to apply dropout to
+            is_training:    A boolean signifying whether we are training or not, or a boolean Tensor selecting the rows (images) of inp to apply dropout to
+        """
+        if isinstance(is_training, bool):
+            return tf.layers.dropout(inp, rate=self.dropout, training=is_training)
+        return tf.where(is_training, tf.layers.dropout(inp, rate=self.dropout, training=True), inp)
+
     def forward_conv_lr(self, inp, weights, reuse=False, scope='', is_training=False):
         """ R2D2 model specification, Linear Regression part:
         - Take in concatenated flattened outputs of layer 3 and 4
@@ -0,0 +1,103 @@
+"""
+Code for data-parallel meta-training over several replicas (processes on one or several hosts).
+
+Every replica trains on its own share of the meta-batch (meta_batch_size / num_replicas tasks),
+computes the meta-gradients of its tasks, and the gradients are averaged over all replicas before
+the optimizer applies them, so all replicas keep identical weights. The average is computed by
+replica 0, which all other replicas connect to over a socket (multiprocessing.connection).
+
+The connections exchange pickled numpy arrays, so only run replicas on trusted hosts and networks.
+
+Usage Instructions (4 replicas on one host, one meta-batch of 32 tasks):
+    python main.py --meta_batch_size=32 --num_replicas=4 --replica_rank=0 ... &
+    python main.py --meta_batch_size=32 --num_replicas=4 --replica_rank=1 ... &
+    python main.py --meta_batch_size=32 --num_replicas=4 --replica_rank=2 ... &
+    python main.py --meta_batch_size=32 --num_replicas=4 --replica_rank=3 ...
+
+    Across hosts, set --coordinator_address=<host of replica 0>:<port> on all replicas.
+"""
+from __future__ import print_function
+import numpy as np
+import time
+
+from multiprocessing.connection import Client, Listener
+
+AUTHKEY = b'r2d2-replicas'
+CONNECT_TIMEOUT = 300 # seconds a replica keeps trying to reach replica 0
+
+def parse_address(address):
+    """ Split a 'host:port' string into a (host, port) tuple """
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+class Replicas(object):
+    """ Connections between the replicas of a data-parallel training run
+
+    Replica 0 holds one connection to every other replica, every other replica one connection to replica 0.
+    """
+    def __init__(self, num_replicas, rank, address):
+        """
+        Args:
+            num_replicas:   Integer number of replicas
+            rank:           Integer rank of this replica, in [0, num_replicas)
+            address:        String 'host:port' on which replica 0 accepts the connections of the other replicas
+        """
+        self.num_replicas = num_replicas
+        self.rank = rank
+        if rank == 0:
+            listener = Listener(parse_address(address), authkey=AUTHKEY)
+            connections = {}
+            while len(connections) < num_replicas - 1:
+                connection = listener.accept()
+                connections[connection.recv()] = connection
+                print('Replica %d/%d connected' % (len(connections), num_replicas - 1))
+            listener.close()
+            # ordered by rank, so the gradients are always summed in the same order
+            self.connections = [connections[r] for r in sorted(connections)]
+        else:
+            start_time = time.time()
+            while True:
+                try:
+                    self.connection = Client(parse_address(address), authkey=AUTHKEY)
+                    break
+                except (IOError, OSError):
+                    if time.time() - start_time > CONNECT_TIMEOUT:
+                        raise
+                    time.sleep(1) # replica 0 is not listening yet
+            self.connection.send(rank)
+            print('Connected to replica 0 at ' + address)
+
+    def broadcast(self, value):
+        """ Return the value of replica 0 on all replicas """
+        if self.rank == 0:
+            for connection in self.connections:
+                connection.send(value)
+            return value
+        return self.connection.recv()
+
+    def allreduce_mean(self, arrays):
+        """ Average a list of numpy arrays over all replicas
+
+        Args:
+            arrays:     List of numpy arrays, with the same shapes on all replicas
+
+        returns:
+            list of numpy arrays with the element-wise means over the replicas
+        """
+        if self.rank == 0:
+            total = [np.array(array, copy=True) for array in arrays]
+            for connection in self.connections:
+                for t, array in zip(total, connection.recv()):
+                    t += array
+            mean = [t / self.num_replicas for t in total]
+            for connection in self.connections:
+                connection.send(mean)
+            return mean
+        self.connection.send(arrays)
+        return self.connection.recv()
+
+    def sync_variables(self, sess, variables):
+        """ Load the values of the variables on replica 0 into the variables on all replicas """
+        values = self.broadcast(sess.run(variables))
+        for var, value in zip(variables, values):
+            var.load(value, sess)
@@ -1,6 +1,7 @@
 """ Utility functions. """
 import numpy as np
 import os
+import pickle
 import random
 import tensorflow as tf
 
@@ -9,8 +10,79 @@ from tensorflow.python.platform import flags
 
 FLAGS = flags.FLAGS
 
+## Directory listing index
+_manifests = {}
+
+def get_manifest(folder, persist=True):
+    """ Fetch the listing of a split folder, which holds one sub folder per class
+
+    The listing is kept in memory, so sampling tasks does not list any directory. If persist,
+    it is also cached on disk in <folder>.manifest.pkl across runs, next to the folder so that
+    writing it does not change the modification time of the folder itself. A cached listing is
+    rebuilt when the modification time of the split folder or of one of its class folders changed.
+
+    Args:
+        folder:         String with the path to the split folder
+        persist:        A boolean to signify whether the listing should be cached on disk or not
+
+    returns:
+        dictionary mapping every class name to the sorted list of its image filenames
+    """
+    folder = os.path.normpath(folder)
+    if folder in _manifests:
+        return _manifests[folder]['classes']
+
+    manifest = None
+    manifest_path = folder + '.manifest.pkl'
+    if persist and os.path.exists(manifest_path):
+        try:
+            with open(manifest_path, 'rb') as f:
+                manifest = pickle.load(f)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            manifest = None
+        if manifest is not None and not _manifest_is_valid(folder, manifest):
+            manifest = None
+
+    if manifest is None:
+        manifest = _build_manifest(folder)
+        if persist:
+            try:
+                with open(manifest_path + '.tmp', 'wb') as f:
+                    pickle.dump(manifest, f)
+                os.rename(manifest_path + '.tmp', manifest_path)
+            except (IOError, OSError):
+                pass # e.g. a read-only dataset folder, keep the listing in memory only
+    _manifests[folder] = manifest
+    return manifest['classes']
+
+def _visible(names):
+    """ Drop the dot-prefixed names of a directory listing, e.g. the .tmp_ files of an interrupted preprocessing run """
+    return [name for name in names if not name.startswith('.')]
+
+def _build_manifest(folder):
+    labels = [label for label in _visible(os.listdir(folder)) if os.path.isdir(os.path.join(folder, label))]
+    return {'mtime': os.path.getmtime(folder),
+            'class_mtimes': dict((label, os.path.getmtime(os.path.join(folder, label))) for label in labels),
+            'classes': dict((label, sorted(_visible(os.listdir(os.path.join(folder, label))))) for label in labels)}
+
+def _manifest_is_valid(folder, manifest):
+    try:
+        return os.path.getmtime(folder) == manifest['mtime'] and \
+            all(os.path.getmtime(os.path.join(folder, label)) == mtime for label, mtime in manifest['class_mtimes'].items())
+    except OSError:
+        return False
+
+def _listdir(path, persist=True):
+    """ List a class folder from the manifest of its split folder, see get_manifest for persist """
+    path = os.path.normpath(path)
+    classes = get_manifest(os.path.dirname(path), persist)
+    label = os.path.basename(path)
+    if label in classes:
+        return classes[label]
+    return sorted(_visible(os.listdir(path)))
+
 ## Image helper
-def get_images(paths, labels, nb_samples=None, shuffle=True):
+def get_images(paths, labels, nb_samples=None, shuffle=True, persist_manifest=True):
     """ Fetch list of tuples of image class and filepath
     
     Args:
@@ -18,6 +90,7 @@ def get_images(paths, labels, nb_samples=None, shuffle=True):
         labels:         List of integers of image classes
         nb_samples:     An integer equal to the amount of samples wanted
         shuffle:        A boolean to signify whether a random shuffle is wanted or not
+        persist_manifest:   A boolean to signify whether the manifests of the split folders may be cached on disk, see get_manifest
 
     returns:
         list of tuples (class, filepath)
@@ -28,7 +101,7 @@ def get_images(paths, labels, nb_samples=None, shuffle=True):
         sampler = lambda x: x
     images = [(i, os.path.join(path, image)) \
         for i, path in zip(labels, paths) \
-        for image in sampler(os.listdir(path))]
+        for image in sampler(_listdir(path, persist_manifest))]
     if shuffle:
         random.shuffle(images)
     return images
@@ -112,3 +185,150 @@ def xent(pred, label):
     """
     # Note - with tf version <=0.12, this loss has incorrect 2nd derivatives
     return tf.nn.softmax_cross_entropy_with_logits(logits=pred, labels=label) / FLAGS.update_batch_size
+
+## Input pipeline helpers
+def input_wait(run_metadata):
+    """ Return the time (seconds) a traced training step waited for its input
+
+    This is the time from the start of the step until the last op of the input pipeline (built under the
+    'input' name scope in main) finished: close to zero if the pipeline keeps up with training, the time
+    needed to produce a meta-batch otherwise.
+
+    Args:
+        run_metadata:   tf.RunMetadata of a training step run with a full trace
+    """
+    node_stats = [node for device_stats in run_metadata.step_stats.dev_stats for node in device_stats.node_stats]
+    input_ends = [node.all_start_micros + node.all_end_rel_micros for node in node_stats if node.node_name.split('/')[0].startswith('input')]
+    if not input_ends:
+        return 0.
+    return (max(input_ends) - min(node.all_start_micros for node in node_stats)) / 1e6
+
+def report_input_wait(run_metadata, step_times):
+    """ Print whether training is input-bound or compute-bound
+
+    The input wait is measured on a traced training step (see input_wait), so no meta-batch is consumed
+    apart from the training steps.
+
+    Args:
+        run_metadata:   tf.RunMetadata of the last training step, run with a full trace
+        step_times:     List of floats with the wall times (seconds) of the recent training steps
+    """
+    wait = input_wait(run_metadata)
+    compute_time = max(np.mean(step_times) - wait, 0.)
+    bound = 'input-bound' if wait > compute_time else 'compute-bound'
+    print('Input wait %.1f ms, compute %.1f ms per step (%s)' % (1000*wait, 1000*compute_time, bound))
+
+## XLA helpers
+def static_shape(tensor):
+    """ Return the shape of tensor as a list, with integers for the statically known dimensions (scalar tensors for the others)
+
+    Shapes built from integers stay static, so the ops using them can be compiled by XLA (see session_config).
+    """
+    dynamic_shape = tf.shape(tensor)
+    return [dim if dim is not None else dynamic_shape[i] for i, dim in enumerate(tensor.get_shape().as_list())]
+
+def session_config():
+    """ Return the tf.ConfigProto of the training and test sessions
+
+    With FLAGS.xla, the graph is clustered and compiled by the XLA JIT, which fuses the small ops of the
+    conv blocks and of the ridge regression. On CPU this also needs the TF_XLA_FLAGS set here, which
+    TensorFlow reads when it optimizes the first graph, so call this before running any session.
+    """
+    config = tf.ConfigProto()
+    if FLAGS.xla:
+        if '--tf_xla_cpu_global_jit' not in os.environ.get('TF_XLA_FLAGS', ''):
+            os.environ['TF_XLA_FLAGS'] = (os.environ.get('TF_XLA_FLAGS', '') + ' --tf_xla_cpu_global_jit').strip()
+        config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+    return config
+
+## Ridge regression helpers
+def select_ridge_form(num_samples, dim):
+    """ Pick the ridge regression formulation with the smallest linear system
+
+    The dual (Woodbury) form solves a num_samples x num_samples system, the primal form
+    a dim x dim system. FLAGS.ridge_form forces one of them unless it is 'auto'.
+
+    Args:
+        num_samples:    An integer equal to the number of samples in the support set (N*K)
+        dim:            An integer equal to the feature dimension
+
+    returns:
+        string 'primal' or 'dual'
+    """
+    if FLAGS.ridge_form == 'auto':
+        form = 'primal' if dim < num_samples else 'dual'
+    elif FLAGS.ridge_form in ('primal', 'dual'):
+        form = FLAGS.ridge_form
+    else:
+        raise ValueError('Unrecognized ridge form: ' + FLAGS.ridge_form)
+    print('Ridge regression: %s form (%d support samples, %d features)' % (form, num_samples, dim))
+    return form
+
+def ridge_regression(x, y, lr_lambda, solver=None, form='dual'):
+    """ Closed-form ridge regression weights
+
+    In the dual form, W = x^T (x x^T + lambda I)^-1 y (Woodbury identity), where the system is
+    solved against y before multiplying with the (wide) x^T. In the primal form,
+    W = (x^T x + lambda I)^-1 x^T y. Both give the same weights, see select_ridge_form.
+
+    Args:
+        x:          Tensor of features, of shape [n, d], or [batch, n, d] to solve a batch of problems at once
+        y:          Tensor of targets, of shape [n, o], or [batch, n, o]
+        lr_lambda:  Tensor with the regularization strength lambda
+        solver:     'inv' (explicit inverse) or 'cholesky' (Cholesky factorization and triangular solves), FLAGS.ridge_solver if None
+        form:       'dual' to solve an n x n system, 'primal' to solve a d x d system
+
+    returns:
+        Tensor of regression weights, of shape [d, o], or [batch, d, o]
+    """
+    solver = solver or FLAGS.ridge_solver
+    with tf.name_scope('ridge_solve'):
+        if form == 'dual':
+            gram = tf.matmul(x, x, transpose_b=True)
+            rhs = y
+        elif form == 'primal':
+            gram = tf.matmul(x, x, transpose_a=True)
+            rhs = tf.matmul(x, y, transpose_a=True)
+        else:
+            raise ValueError('Unrecognized ridge form: ' + form)
+        system = gram + lr_lambda * tf.eye(static_shape(gram)[-1]) # a constant when the shape is static
+        if solver == 'cholesky':
+            # the system is symmetric positive definite for lambda > 0
+            solution = tf.cholesky_solve(tf.cholesky(system), rhs)
+        elif solver == 'inv':
+            solution = tf.matmul(tf.linalg.inv(system), rhs)
+        else:
+            raise ValueError('Unrecognized ridge solver: ' + solver)
+        if form == 'dual':
+            return tf.matmul(x, solution, transpose_a=True)
+        return solution
+
+## Evaluation helpers
+class RunningStats(object):
+    """ Running mean and standard deviation of a stream of equally shaped arrays (Welford's algorithm)
+
+    Keeps memory constant in the number of values, e.g. the per-episode accuracies of an evaluation.
+    """
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self.m2 = None # sum of squared differences from the mean
+
+    def update(self, value):
+        """ Add one value (a number or numpy array) to the statistics """
+        value = np.asarray(value, dtype=np.float64)
+        self.count += 1
+        if self.mean is None:
+            self.mean = np.zeros_like(value)
+            self.m2 = np.zeros_like(value)
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def std(self):
+        """ Return the (population) standard deviation, as np.std """
+        return np.sqrt(self.m2 / self.count)
+
+    def ci95(self):
+        """ Return the half-width of the 95% confidence interval of the mean """
+        return 1.96 * self.std() / np.sqrt(self.count)
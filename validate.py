@@ -0,0 +1,81 @@
+"""
+Code for validating checkpoints out of band, in a process running next to training.
+
+The validation worker builds only the meta-validation graph, watches the checkpoint directory of the
+experiment, and evaluates every new checkpoint on the fixed, seeded set of meta-validation episodes
+(all 600 of them, instead of the single meta-batch of the inline validation). The results are written
+to the summary directory of the experiment, next to the training curves.
+
+Usage Instructions:
+    Train without the inline validation, and run the worker with the same flags next to it:
+        python main.py --inline_validation=False ...
+        python main.py --validation_worker=True ...
+"""
+from __future__ import print_function
+import numpy as np
+import os
+import tensorflow as tf
+import time
+
+from checkpointing import restore_checkpoint
+from tensorflow.python.platform import flags
+
+FLAGS = flags.FLAGS
+
+POLL_INTERVAL = 30 # seconds between two looks at the checkpoint directory
+
+def checkpoint_iteration(model_file):
+    """ Return the iteration of a checkpoint named <logdir>/model<itr> """
+    return int(os.path.basename(model_file)[len('model'):])
+
+def validate_checkpoint(model, sess, data_generator):
+    """ Return the mean pre-update and post-update accuracy over all meta-validation episodes
+
+    The sampler cycles through the episodes in whole meta-batches (see DataGenerator.make_input_pipeline), so
+    consuming one cycle per checkpoint keeps every checkpoint starting at the first episode. The surplus
+    tasks of the last meta-batch of a cycle are dropped, as in test() in main.py.
+    """
+    sampler = data_generator.metaval_sampler
+    accuracies = []
+    for _ in range(sampler.cycle_length // data_generator.batch_size):
+        result = sess.run([model.test_accuraciesa, model.test_accuraciesb[FLAGS.num_updates-1]])
+        accuracies.extend(zip(*result))
+    return np.mean(accuracies[:sampler.num_episodes], 0)
+
+def run_validation_worker(model, sess, loader, data_generator, logdir, final_itr):
+    """ Validate every new checkpoint in logdir, until the checkpoint of iteration final_itr is validated
+
+    Args:
+        model:              Model object with the meta-validation graph constructed
+        sess:               TensorFlow session object
+        loader:             tf.train.Saver restoring the variables of the model
+        data_generator:     DataGenerator object with the meta-validation input pipeline
+        logdir:             String with the experiment folder holding the checkpoints and summaries
+        final_itr:          Integer iteration of the last checkpoint of the training run
+    """
+    writer = tf.summary.FileWriter(logdir)
+    validated = set()
+    while final_itr not in validated:
+        state = tf.train.get_checkpoint_state(logdir)
+        model_files = [path for path in (state.all_model_checkpoint_paths if state else [])
+                       if checkpoint_iteration(path) not in validated]
+        if not model_files:
+            time.sleep(POLL_INTERVAL)
+            continue
+
+        for model_file in sorted(model_files, key=checkpoint_iteration):
+            itr = checkpoint_iteration(model_file)
+            try:
+                restore_checkpoint(sess, loader, model_file, tf.global_variables())
+            except tf.errors.NotFoundError: # pruned by training before it was validated
+                print('Skipping pruned checkpoint ' + model_file)
+                validated.add(itr)
+                continue
+            result = validate_checkpoint(model, sess, data_generator)
+            print('Validation results at iteration %d: %s, %s' % (itr, result[0], result[1]))
+            writer.add_summary(tf.Summary(value=[
+                tf.Summary.Value(tag='validation/Pre-update accuracy', simple_value=result[0]),
+                tf.Summary.Value(tag='validation/Post-update accuracy', simple_value=result[1])]), itr)
+            writer.flush()
+            validated.add(itr)
+    writer.close()